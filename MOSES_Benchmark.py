@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+#
+
+import numpy as np
+import cv2
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import multiprocessing
+from StringIO import StringIO
+from MOSES_ImageAnalysis import ImageAnalysis
+from MOSES_UndistortImage import Undistort
+from MOSES_Results import ResultsWriter
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows: the peak memory is then not reported.
+    resource = None
+
+"""
+Stage-level benchmark of the undistortion and analysis chain on deterministic synthetic canopy images. Every stage is
+timed on its own and the results are printed as JSON lines, one per resolution and stage, so that runs on different
+machines or commits can be compared by a script. Each resolution runs in a process of its own, whose peak memory is
+reported on one more line.
+"""
+
+# Width and height of the benchmarked resolutions.
+RESOLUTIONS = {'vga': (640, 480),
+               'hd': (1280, 720),
+               '4mp': (2592, 1456),
+               '12mp': (4000, 3000),
+               '24mp': (6000, 4000)}
+
+# Calibration used to undistort the synthetic images, scaled from its own resolution to theirs.
+CALIBRATION_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'out_CAMERADATA_Orizzontal.xml')
+CALIBRATION_SIZE = (2592, 1456)
+
+
+def synthetic_canopy(width, height, seed=0):
+    """
+    Draws a synthetic canopy photo: a bright sky gradient partly covered by dark foliage blobs of random size, with
+    sensor-like noise. The same seed always gives the same image.
+    :param width: the image width.
+    :param height: the image height.
+    :param seed: the seed of the random generator.
+    :return: the BGR image.
+    """
+    rng = np.random.RandomState(seed)
+    sky = np.linspace(255, 170, height).astype(np.uint8)[:, np.newaxis]
+    img = np.empty((height, width, 3), np.uint8)
+    img[:] = np.dstack([sky, sky - 15, sky - 60])
+    scale = min(width, height)
+    for i in xrange(int(rng.randint(60, 120))):
+        center = (int(rng.randint(0, width)), int(rng.randint(0, height)))
+        axes = (int(rng.uniform(0.02, 0.15) * scale), int(rng.uniform(0.02, 0.15) * scale))
+        color = tuple(int(c) for c in rng.randint(10, 90, 3))
+        cv2.ellipse(img, center, axes, float(rng.uniform(0, 180)), 0, 360, color, -1)
+    noise = rng.normal(0, 6, img.shape)
+
+    return np.clip(img + noise, 0, 255).astype(np.uint8)
+
+
+def scaled_calibration(width, height):
+    """
+    Loads the camera calibration and scales it to another resolution.
+    :param width: the image width.
+    :param height: the image height.
+    :return: the camera matrix and the distortion coefficients.
+    """
+    cm = Undistort.load_from_xml(CALIBRATION_PATH, 'Camera_Matrix')
+    dc = Undistort.load_from_xml(CALIBRATION_PATH, 'Distortion_Coefficients')
+    cm[0] *= float(width) / CALIBRATION_SIZE[0]
+    cm[1] *= float(height) / CALIBRATION_SIZE[1]
+    cm[2, 2] = 1
+
+    return cm, dc
+
+
+def peak_memory_mb():
+    """
+    Gets the peak resident memory of the process.
+    :return: the peak in megabytes, None where it can't be measured.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def run_resolution_process(args):
+    """
+    Benchmarks one resolution in a worker process, see 'Benchmark.run'.
+    :param args: a tuple (benchmark, resolution name, scratch directory).
+    :return: a tuple (records of 'Benchmark.run_resolution', peak memory of the process in megabytes).
+    """
+    benchmark, name, work_dir = args
+    records = benchmark.run_resolution(name, work_dir)
+    return records, peak_memory_mb()
+
+
+def verify_binarization(count=50):
+    """
+    Checks that 'ImageAnalysis.otsu_binarization' gives the same image as 'ImageAnalysis.reference_binarization', on
+    synthetic canopies of every resolution and on random images of narrow gray ranges, constant ones included.
+    :param count: the number of random images.
+    :return: the list of the descriptions of the images which differ, empty if all are the same.
+    """
+    images = [('canopy ' + name, cv2.cvtColor(synthetic_canopy(width, height, seed), cv2.COLOR_BGR2GRAY))
+              for seed, (name, (width, height)) in enumerate(sorted(RESOLUTIONS.items()))]
+    rng = np.random.RandomState(0)
+    for i in xrange(count):
+        low = int(rng.randint(0, 256))
+        high = int(rng.randint(low, 256))
+        shape = tuple(int(v) for v in rng.randint(1, 200, 2))
+        images.append(('random {} {}-{}'.format(shape, low, high), rng.randint(low, high + 1, shape).astype(np.uint8)))
+    return [description for description, img in images
+            if not np.array_equal(ImageAnalysis.otsu_binarization(img), ImageAnalysis.reference_binarization(img))]
+
+
+class Benchmark(object):
+    """
+    Class which contains functions definition to time each stage of the processing chain.
+    """
+    def __init__(self, **kwargs):
+        """
+        Constructor.
+        :param kwargs: - 'repeat': number of timed runs of each stage, the median is reported. 5 by default;
+                       - 'sub_sampling_size' and 'rejection_area': the analysis grid, 15 and 0.1 by default;
+                       - 'rows': number of rows written by the '.csv' stage, 1000 by default.
+        """
+        self.repeat = kwargs['repeat'] if ('repeat' in kwargs.keys()) else 5
+        self.sub_sampling_size = kwargs['sub_sampling_size'] if ('sub_sampling_size' in kwargs.keys()) else 15
+        self.rejection_area = kwargs['rejection_area'] if ('rejection_area' in kwargs.keys()) else 0.1
+        self.rows = kwargs['rows'] if ('rows' in kwargs.keys()) else 1000
+
+    def time_stage(self, function):
+        """
+        Times a stage. The library prints are silenced while it runs.
+        :param function: the stage, called without arguments.
+        :return: the median run time in seconds.
+        """
+        times = []
+        stdout = sys.stdout
+        for i in xrange(self.repeat):
+            sys.stdout = StringIO()
+            try:
+                start = time.time()
+                function()
+                times.append(time.time() - start)
+            finally:
+                sys.stdout = stdout
+
+        return float(np.median(times))
+
+    def run_resolution(self, name, work_dir):
+        """
+        Benchmarks every stage on a synthetic image of one resolution.
+        :param name: a key of 'RESOLUTIONS'.
+        :param work_dir: a scratch directory.
+        :return: a list of dictionaries, one per stage, with keys 'resolution', 'width', 'height', 'stage',
+        'seconds', 'images_per_sec' and 'megapixels_per_sec'.
+        """
+        width, height = RESOLUTIONS[name]
+        image_dir = os.path.join(work_dir, name)
+        os.makedirs(image_dir)
+        image_path = os.path.join(image_dir, 'canopy.jpg')
+        cv2.imwrite(image_path, synthetic_canopy(width, height))
+
+        cm, dc = scaled_calibration(width, height)
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            undistort = Undistort(image_dir, cm, dc)
+            analysis = ImageAnalysis(image_dir, [], sub_sampling_size=self.sub_sampling_size,
+                                     rejection_area=self.rejection_area)
+            color = cv2.imread(image_path)
+            gray = undistort.undistort_decoded(color).copy()
+            binarized = analysis.otsu_binarization(gray)
+            grid, aoi = analysis.rejection_grid(gray)
+            measurement = analysis.measure_array(gray, image_path)
+        finally:
+            sys.stdout = stdout
+
+        def write_csv():
+            with ResultsWriter(analysis) as writer:
+                for i in xrange(self.rows):
+                    writer.write('canopy.jpg', measurement)
+
+        # Each stage: (name, function, number of images it processes, whether it works on the pixels).
+        stages = [('load_from_xml', lambda: scaled_calibration(width, height), 1, False),
+                  ('build_remap_table', lambda: undistort.build_remap_table((width, height)), 1, True),
+                  ('decode', lambda: cv2.imread(image_path), 1, True),
+                  ('undistort_image', lambda: undistort.undistort_image(image_path), 1, True),
+                  ('undistort_array', lambda: undistort.undistort_array(color), 1, True),
+                  ('otsu_binarization', lambda: analysis.otsu_binarization(gray), 1, True),
+                  ('reference_binarization', lambda: analysis.reference_binarization(gray), 1, True),
+                  ('rejection_grid', lambda: analysis.rejection_grid(gray), 1, False),
+                  ('compute_results', lambda: analysis.compute_results(measurement['leaf_pix'], gray, grid, aoi),
+                   1, True),
+                  ('compute_results_binarized', lambda: analysis.compute_results_binarized(measurement['leaf_pix'],
+                                                                                           binarized, grid, aoi),
+                   1, True),
+                  ('measure_array', lambda: analysis.measure_array(gray, image_path), 1, True),
+                  ('csv_output', write_csv, self.rows, False)]
+        records = []
+        for stage, function, images, pixels in stages:
+            seconds = self.time_stage(function)
+            rate = images / seconds if seconds > 0 else None
+            records.append({'resolution': name, 'width': width, 'height': height, 'stage': stage,
+                            'seconds': seconds,
+                            'images_per_sec': rate,
+                            'megapixels_per_sec': rate * width * height / 1e6 if rate and pixels else None})
+        return records
+
+    def run(self, resolutions, output=sys.stdout):
+        """
+        Benchmarks every stage at each resolution, printing the JSON lines of the records of a resolution as soon as
+        it is done. Each resolution runs in a new process, so that the peak memory of one doesn't include the others:
+        it is reported by a last record with keys 'resolution', 'width', 'height', 'stage' ('peak_memory') and
+        'peak_memory_mb', None where it can't be measured.
+        :param resolutions: a list of keys of 'RESOLUTIONS'.
+        :param output: the stream the JSON lines are written to.
+        :return: the list of all the records.
+        """
+        work_dir = tempfile.mkdtemp(prefix='moses_benchmark_')
+        records = []
+        try:
+            for name in resolutions:
+                pool = multiprocessing.Pool(1)
+                try:
+                    resolution_records, peak = pool.apply(run_resolution_process, ((self, name, work_dir),))
+                finally:
+                    pool.close()
+                    pool.join()
+                width, height = RESOLUTIONS[name]
+                resolution_records.append({'resolution': name, 'width': width, 'height': height,
+                                           'stage': 'peak_memory', 'peak_memory_mb': peak})
+                for record in resolution_records:
+                    output.write(json.dumps(record, sort_keys=True) + '\n')
+                    output.flush()
+                    records.append(record)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        return records
+
+
+def main():
+    """
+    Runs the benchmark from the command line.
+    :return: Nothing.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark each stage of the undistortion and analysis chain.')
+    parser.add_argument('--resolutions', default='vga,hd,4mp,12mp,24mp',
+                        help='comma separated list among ' + ', '.join(sorted(RESOLUTIONS)))
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs of each stage')
+    parser.add_argument('--output', default=None, help='JSON lines file, standard output by default')
+    parser.add_argument('--verify', action='store_true',
+                        help='only check that the fast binarization gives the same images as the reference one')
+    args = parser.parse_args()
+
+    if args.verify:
+        mismatches = verify_binarization()
+        for description in mismatches:
+            print 'MISMATCH:', description
+        print 'Binarization check:', 'FAILED' if mismatches else 'OK'
+        sys.exit(1 if mismatches else 0)
+
+    benchmark = Benchmark(repeat=args.repeat)
+    resolutions = args.resolutions.split(',')
+    if args.output is None:
+        benchmark.run(resolutions)
+    else:
+        with open(args.output, 'w') as f:
+            benchmark.run(resolutions, f)
+
+
+if __name__ == '__main__':
+    main()
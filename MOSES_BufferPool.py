@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#
+
+import numpy as np
+
+
+class NoBuffers(object):
+    """
+    Class which stands for 'BufferPool' when the results must be arrays of their own: OpenCV then allocates every
+    'dst' output.
+    """
+    def get(self, name, shape, dtype=np.uint8):
+        return None
+
+    def like(self, name, img):
+        return None
+
+
+# The default of the functions taking a pool, which then return arrays of their own.
+NO_BUFFERS = NoBuffers()
+
+
+class BufferPool(object):
+    """
+    Class which keeps the working arrays of the processing, such as the blurred or the binarized image, so that they
+    are allocated for the first image only and reused for the following ones, which share its resolution. The arrays
+    are handed to OpenCV as 'dst' outputs. A buffer is overwritten by the next image: a result which outlives the
+    processing of its image, such as an image written on a background thread, must not use one.
+    """
+    def __init__(self):
+        """
+        Constructor. The pool starts empty.
+        """
+        # The arrays by (name, shape, dtype).
+        self.buffers = dict()
+        # The number of arrays allocated so far, which stops growing once every resolution has been met.
+        self.allocations = 0
+
+    def __getstate__(self):
+        # A worker process allocates its own buffers instead of receiving copies of these.
+        return {'buffers': dict(), 'allocations': 0}
+
+    def get(self, name, shape, dtype=np.uint8):
+        """
+        Gets a buffer, allocating it the first time. Its content is whatever the previous image left in it.
+        :param name: the role of the buffer, such as 'blur': buffers used at the same time have different names.
+        :param shape: the shape of the array.
+        :param dtype: the type of the elements of the array.
+        :return: the array.
+        """
+        key = (name, tuple(int(v) for v in shape), np.dtype(dtype).str)
+        buf = self.buffers.get(key)
+        if buf is None:
+            buf = np.empty(key[1], dtype=dtype)
+            self.buffers[key] = buf
+            self.allocations += 1
+        return buf
+
+    def like(self, name, img):
+        """
+        Gets a buffer of the shape and type of an image, see 'get'.
+        :param name: the role of the buffer.
+        :param img: the image.
+        :return: the array.
+        """
+        return self.get(name, img.shape, img.dtype)
+
+    def nbytes(self):
+        """
+        Gets the memory held by the pool.
+        :return: the number of bytes of all the buffers.
+        """
+        return sum(buf.nbytes for buf in self.buffers.values())
+
+    def clear(self):
+        """
+        Releases all the buffers, for example when the resolution of the images changes for good.
+        :return: Nothing.
+        """
+        self.buffers = dict()
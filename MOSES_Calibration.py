@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+#
+
+import os
+import json
+import struct
+import fnmatch
+import cv2
+from MOSES_UndistortImage import Undistort
+
+# JPEG markers which start a frame header and carry the image size, see 'jpeg_size'.
+SOF_MARKERS = set(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+
+
+def jpeg_size(file_path):
+    """
+    Reads the size of a JPEG image from its frame header, without decoding it.
+    :param file_path: the file path.
+    :return: the size as (width, height), None if the file is not a JPEG image.
+    """
+    with open(file_path, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            return None
+        while True:
+            byte = f.read(1)
+            while byte and byte != b'\xff':
+                byte = f.read(1)
+            while byte == b'\xff':
+                byte = f.read(1)
+            if not byte:
+                return None
+            marker = ord(byte)
+            if marker == 0x01 or 0xd0 <= marker <= 0xd8:
+                # Markers without a segment.
+                continue
+            length = f.read(2)
+            if len(length) < 2:
+                return None
+            if marker in SOF_MARKERS:
+                header = f.read(5)
+                if len(header) < 5:
+                    return None
+                height, width = struct.unpack('>xHH', header)
+                return width, height
+            f.seek(struct.unpack('>H', length)[0] - 2, os.SEEK_CUR)
+
+
+class CalibrationRegistry(object):
+    """
+    Class which holds the calibrations of several cameras, such as the horizontal and the vertical one, and tells which
+    camera each image was taken with, so that a survey mixing them is processed in a single pass. Each calibration file
+    is parsed once. Each camera keeps an 'Undistort' object, with the optimal new camera matrix, the region of interest
+    and the undistortion maps of every image size it meets.
+    An image is routed to the first camera whose rules all match it: 'folder', a pattern matched against the name of
+    any of the folders the image is in, 'pattern', a pattern matched against the file name, and 'size', the (width,
+    height) of the image as stored in the file. The images no camera matches go to the default camera.
+    """
+    def __init__(self, image_directory, **kwargs):
+        """
+        Constructor. The registry starts without cameras, see 'add'.
+        :param image_directory: the directory of the survey. Its images may be in subfolders, for example one for each
+        camera.
+        :param kwargs: - 'alpha': free scaling parameter of the optimal new camera matrix, 1 by default.
+        """
+        self.image_directory = image_directory
+        self.alpha = kwargs['alpha'] if ('alpha' in kwargs.keys()) else 1
+        self.save_path = os.path.join(image_directory, 'Undistorted_Images')
+        if not os.path.exists(self.save_path):
+            os.makedirs(self.save_path)
+        # The cameras, in the order their rules are tried, as dictionaries with keys 'name', 'calibration_path',
+        # 'folder', 'pattern' and 'size'.
+        self.cameras = []
+        self.default = None
+        # The parsed calibration files, by path.
+        self.matrices = dict()
+        # The 'Undistort' objects, by calibration file: the cameras sharing a file share one. Each is created for the
+        # first image it undistorts.
+        self.undistorts = dict()
+        # The camera of each image already routed, by path.
+        self.routes = dict()
+
+    @staticmethod
+    def from_json(path, image_directory):
+        """
+        Loads a registry from a JSON file which looks like this:
+        {"alpha": 1, "default": "horizontal", "cameras": [
+            {"name": "horizontal", "calibration": "out_CAMERADATA_Orizzontal.xml", "folder": "*Orizz*"},
+            {"name": "vertical", "calibration": "CAMERADATA_Vertical_old.xml", "pattern": "*_V_*.jpg",
+             "size": [4000, 6000]}]}
+        The calibration paths are relative to the JSON file. "alpha" and "default" are optional: the default camera
+        is the first one.
+        :param path: the JSON file path.
+        :param image_directory: the directory of the survey.
+        :return: the registry.
+        """
+        with open(path) as f:
+            config = json.load(f)
+        registry = CalibrationRegistry(image_directory, alpha=config.get('alpha', 1))
+        base = os.path.dirname(os.path.abspath(path))
+        for camera in config['cameras']:
+            registry.add(camera['name'], os.path.join(base, camera['calibration']), folder=camera.get('folder'),
+                         pattern=camera.get('pattern'), size=camera.get('size'))
+        if 'default' in config:
+            registry.set_default(config['default'])
+        return registry
+
+    def add(self, name, calibration_path, **kwargs):
+        """
+        Adds a camera. The first camera added is the default one.
+        :param name: the camera name.
+        :param calibration_path: the calibration results file of the camera, see 'Undistort.load_from_xml'.
+        :param kwargs: - 'folder': a pattern, such as '*Vert*', matched against the folders of the image;
+                       - 'pattern': a pattern, such as '*_V_*.jpg', matched against the file name of the image;
+                       - 'size': the (width, height) of the images of the camera.
+                       The rules not given match every image.
+        :return: Nothing.
+        """
+        if any(camera['name'] == name for camera in self.cameras):
+            raise ValueError('Camera {} is already registered'.format(name))
+        if calibration_path not in self.matrices:
+            self.matrices[calibration_path] = (Undistort.load_from_xml(calibration_path, 'Camera_Matrix'),
+                                               Undistort.load_from_xml(calibration_path, 'Distortion_Coefficients'))
+        size = kwargs['size'] if ('size' in kwargs.keys()) else None
+        self.cameras.append({'name': name, 'calibration_path': calibration_path,
+                             'folder': kwargs['folder'] if ('folder' in kwargs.keys()) else None,
+                             'pattern': kwargs['pattern'] if ('pattern' in kwargs.keys()) else None,
+                             'size': tuple(size) if size is not None else None})
+        if self.default is None:
+            self.default = name
+        self.routes = dict()
+
+    def set_default(self, name):
+        """
+        Sets the camera of the images no camera matches.
+        :param name: the camera name.
+        :return: Nothing.
+        """
+        if not any(camera['name'] == name for camera in self.cameras):
+            raise ValueError('Unknown camera: {}'.format(name))
+        self.default = name
+        self.routes = dict()
+
+    @staticmethod
+    def image_size(file_path):
+        """
+        Gets the size of an image, from its header for a JPEG image.
+        :param file_path: the file path.
+        :return: the size as (width, height), None if the image can't be read.
+        """
+        size = jpeg_size(file_path)
+        if size is None:
+            img = cv2.imread(file_path, cv2.IMREAD_UNCHANGED)
+            if img is not None:
+                size = img.shape[1], img.shape[0]
+        return size
+
+    def matches(self, camera, file_path):
+        """
+        Checks whether an image matches the rules of a camera.
+        :param camera: the camera, a dictionary of 'self.cameras'.
+        :param file_path: the image file path.
+        :return: True if every rule of the camera matches.
+        """
+        if camera['folder'] is not None:
+            folder = os.path.relpath(os.path.dirname(os.path.abspath(file_path)),
+                                     os.path.abspath(self.image_directory))
+            folders = [os.path.normcase(f) for f in folder.split(os.sep)]
+            if not fnmatch.filter(folders, os.path.normcase(camera['folder'])):
+                return False
+        if camera['pattern'] is not None and not fnmatch.fnmatch(os.path.basename(file_path), camera['pattern']):
+            return False
+        if camera['size'] is not None and self.image_size(file_path) != camera['size']:
+            return False
+        return True
+
+    def camera_name(self, file_path):
+        """
+        Routes an image to its camera, see the class description.
+        :param file_path: the image file path.
+        :return: the camera name.
+        """
+        if file_path not in self.routes:
+            if self.default is None:
+                raise ValueError('No camera is registered')
+            names = [camera['name'] for camera in self.cameras if self.matches(camera, file_path)]
+            self.routes[file_path] = names[0] if names else self.default
+        return self.routes[file_path]
+
+    def route(self, image):
+        """
+        Gets the 'Undistort' object of the camera an image was taken with. It is created for the first image of the
+        calibration file of the camera, from the calibration parsed by 'add'.
+        :param image: a dictionary with keys 'name' and 'path', as in 'Pipeline.file_list'.
+        :return: the 'Undistort' object.
+        """
+        name = self.camera_name(image['path'])
+        calibration_path = [camera for camera in self.cameras if camera['name'] == name][0]['calibration_path']
+        if calibration_path not in self.undistorts:
+            camera_matrix, distortion_coefficient = self.matrices[calibration_path]
+            print 'Camera', name, 'calibration:', calibration_path
+            self.undistorts[calibration_path] = Undistort(self.image_directory, camera_matrix, distortion_coefficient,
+                                                          calibration_path=calibration_path, alpha=self.alpha,
+                                                          file_list=[image])
+        return self.undistorts[calibration_path]
+
+    def image_list(self, extensions=('.jpg',)):
+        """
+        Lists the images of the survey, in its directory and its subfolders. The undistorted images are left out.
+        :param extensions: the extensions of the image files.
+        :return: a list of dictionaries with keys 'name' (the file path relative to the survey directory) and 'path'.
+        """
+        file_list = []
+        for root, dirs, files in os.walk(self.image_directory):
+            dirs[:] = sorted(d for d in dirs
+                             if os.path.normpath(os.path.join(root, d)) != os.path.normpath(self.save_path))
+            for f in sorted(files):
+                if f.lower().endswith(extensions):
+                    path = os.path.join(root, f)
+                    file_list.append({'name': os.path.relpath(path, self.image_directory), 'path': path})
+        return file_list
+
+    def summary(self):
+        """
+        Counts the images routed to each camera so far.
+        :return: a dictionary of the number of images by camera name.
+        """
+        counts = dict((camera['name'], 0) for camera in self.cameras)
+        for name in self.routes.values():
+            counts[name] += 1
+        return counts
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+#
+
+import os
+import re
+import csv
+import math
+import argparse
+import calendar
+import numpy as np
+from datetime import datetime
+
+"""
+Spatial and time index over the results of a batch. The images are named by the camera after their GPS position and
+capture time, for example '44.809962_12.2005725_20180705144945047000_img.png': these are parsed into numeric columns,
+bucketed on a grid of square cells and sorted by time, so that the porosity around a point, along each orchard row or
+within a time window is found without scanning the whole table.
+"""
+
+# Latitude, longitude and capture time (yyyymmddHHMMSS followed by the fraction of second) at the start of a name.
+IMAGE_NAME_PATTERN = re.compile(r'^(-?\d+(?:\.\d+)?)_(-?\d+(?:\.\d+)?)_(\d{14})(\d*)_')
+# Mean earth radius, in meters.
+EARTH_RADIUS = 6371000.0
+
+
+def parse_image_name(file_name):
+    """
+    Reads the GPS position and the capture time from an image name.
+    :param file_name: the file name, such as '44.809962_12.2005725_20180705144945047000_img.png'. It may be preceded
+    by the folder of the image.
+    :return: a tuple (latitude, longitude, timestamp), the timestamp in seconds since 1970 as written by the camera,
+    without time zone. None if the name doesn't follow the pattern.
+    """
+    match = IMAGE_NAME_PATTERN.match(os.path.basename(file_name))
+    if match is None:
+        return None
+    latitude, longitude, seconds, fraction = match.groups()
+    try:
+        capture = datetime.strptime(seconds, '%Y%m%d%H%M%S')
+    except ValueError:
+        return None
+    timestamp = calendar.timegm(capture.timetuple()) + (float('0.' + fraction) if fraction else 0.0)
+
+    return float(latitude), float(longitude), timestamp
+
+
+def parse_image_names(file_names):
+    """
+    Reads the GPS positions and capture times of a list of image names, see 'parse_image_name'.
+    :param file_names: the file names.
+    :return: three arrays: latitude, longitude and timestamp, NaN for the names which don't follow the pattern.
+    """
+    fields = np.full((len(file_names), 3), np.nan)
+    for i, file_name in enumerate(file_names):
+        parsed = parse_image_name(file_name)
+        if parsed is not None:
+            fields[i] = parsed
+
+    return fields[:, 0], fields[:, 1], fields[:, 2]
+
+
+class GeoIndex(object):
+    """
+    Class which indexes the porosity of a set of images by position and by capture time. The positions are projected
+    on a local plane, in meters, and bucketed on a grid of square cells; the capture times are kept sorted. The images
+    whose name carries no position are left out.
+    """
+    def __init__(self, file_names, porosity, labels, **kwargs):
+        """
+        Constructor.
+        :param file_names: the image names.
+        :param porosity: the porosity of each image for each threshold (images x thresholds).
+        :param labels: the name of each threshold column, such as 'Porosity 0.40'.
+        :param kwargs: - 'cell_size': the side of the grid cells, in meters. 10 by default.
+        """
+        self.cell_size = float(kwargs['cell_size']) if ('cell_size' in kwargs.keys()) else 10.0
+        latitude, longitude, timestamp = parse_image_names(file_names)
+        valid = np.isfinite(latitude)
+        self.file_names = np.asarray(file_names)[valid]
+        self.porosity = np.asarray(porosity, dtype=np.float64).reshape(len(file_names), -1)[valid]
+        self.labels = list(labels)
+        self.latitude = latitude[valid]
+        self.longitude = longitude[valid]
+        self.timestamp = timestamp[valid]
+
+        # Equirectangular projection around the center of the images: accurate to a few centimeters over a farm.
+        self.origin = (float(np.mean(self.latitude)), float(np.mean(self.longitude))) if valid.any() else (0.0, 0.0)
+        self.x, self.y = self.project(self.latitude, self.longitude)
+
+        # Grid buckets: the images sorted by cell, and the range of each cell in that order.
+        cx, cy = self.cell_of(self.x, self.y)
+        self.cell_order = np.lexsort((cy, cx))
+        keys = np.stack([cx[self.cell_order], cy[self.cell_order]], axis=1)
+        starts = np.flatnonzero(np.r_[True, np.any(keys[1:] != keys[:-1], axis=1)]) if len(keys) else np.array([], int)
+        stops = np.r_[starts[1:], len(keys)]
+        self.buckets = dict(((int(keys[s, 0]), int(keys[s, 1])), (int(s), int(e))) for s, e in zip(starts, stops))
+
+        self.time_order = np.argsort(self.timestamp, kind='mergesort')
+        self.sorted_times = self.timestamp[self.time_order]
+
+    @classmethod
+    def from_csv(cls, path, **kwargs):
+        """
+        Builds the index of a '.csv' table written by 'ResultsWriter'.
+        :param path: the '.csv' file path.
+        :param kwargs: the options of the constructor.
+        :return: the index.
+        """
+        with open(path, 'rb') as f:
+            rows = list(csv.reader(f, delimiter=';'))
+        header, rows = rows[0], [row for row in rows[1:] if row]
+        porosity = np.array([[float(v) for v in row[2:]] for row in rows], dtype=np.float64).reshape(len(rows), -1)
+
+        return cls([row[0] for row in rows], porosity, header[2:], **kwargs)
+
+    @classmethod
+    def from_npz(cls, path, **kwargs):
+        """
+        Builds the index of a '.npz' file written by 'ResultsWriter'.
+        :param path: the '.npz' file path.
+        :param kwargs: the options of the constructor.
+        :return: the index.
+        """
+        data = np.load(path)
+        fraction_cover = data['fraction_cover']
+        # As in the '.csv' table: an image without crown has porosity 0.
+        porosity = np.where(fraction_cover == 0, 0.0, 1.0 - fraction_cover)
+        labels = ['Porosity_Can-EYE_Comparison' if t > 1 else 'Porosity {:.2f}'.format(t) for t in data['threshes']]
+
+        return cls(list(data['file_name']), porosity, labels, **kwargs)
+
+    def project(self, latitude, longitude):
+        """
+        Projects positions on the local plane of the index.
+        :param latitude: the latitudes, in degrees.
+        :param longitude: the longitudes, in degrees.
+        :return: the east and north coordinates, in meters from the center of the images.
+        """
+        lat0, lon0 = self.origin
+        x = EARTH_RADIUS * np.radians(np.asarray(longitude, dtype=np.float64) - lon0) * math.cos(math.radians(lat0))
+        y = EARTH_RADIUS * np.radians(np.asarray(latitude, dtype=np.float64) - lat0)
+
+        return x, y
+
+    def cell_of(self, x, y, cell_size=None):
+        """
+        Gets the grid cell of positions on the local plane.
+        :param x: the east coordinates, in meters.
+        :param y: the north coordinates, in meters.
+        :param cell_size: the side of the cells, 'self.cell_size' if None.
+        :return: the column and row of the cells.
+        """
+        cell_size = self.cell_size if cell_size is None else cell_size
+        return np.floor(x / cell_size).astype(np.int64), np.floor(y / cell_size).astype(np.int64)
+
+    def within_radius(self, latitude, longitude, radius):
+        """
+        Finds the images taken within a distance of a point. Only the grid cells the circle touches are searched.
+        :param latitude: the latitude of the point, in degrees.
+        :param longitude: the longitude of the point, in degrees.
+        :param radius: the distance, in meters.
+        :return: the indices of the images, from the nearest.
+        """
+        x, y = self.project(latitude, longitude)
+        (cx1, cx2), (cy1, cy2) = self.cell_of(np.array([x - radius, x + radius]), np.array([y - radius, y + radius]))
+        if (cx2 - cx1 + 1) * (cy2 - cy1 + 1) > len(self.buckets):
+            # A circle wider than the images: checking every cell is cheaper than looking up the empty ones.
+            ranges = self.buckets.values()
+        else:
+            ranges = [self.buckets[(i, j)] for i in xrange(cx1, cx2 + 1) for j in xrange(cy1, cy2 + 1)
+                      if (i, j) in self.buckets]
+        if not ranges:
+            return np.array([], dtype=np.int64)
+        candidates = np.concatenate([self.cell_order[start:stop] for start, stop in ranges])
+        distance = np.hypot(self.x[candidates] - x, self.y[candidates] - y)
+        inside = distance <= radius
+
+        return candidates[inside][np.argsort(distance[inside], kind='mergesort')]
+
+    def time_window(self, start, end):
+        """
+        Finds the images taken within a time window.
+        :param start: the start of the window, in seconds since 1970 or as a 'datetime'.
+        :param end: the end of the window, excluded.
+        :return: the indices of the images, in capture order.
+        """
+        if isinstance(start, datetime):
+            start = calendar.timegm(start.timetuple()) + start.microsecond / 1e6
+        if isinstance(end, datetime):
+            end = calendar.timegm(end.timetuple()) + end.microsecond / 1e6
+        first, last = np.searchsorted(self.sorted_times, [start, end], side='left')
+
+        return self.time_order[first:last]
+
+    def track_rows(self, max_turn=45.0, max_gap=60.0, min_step=0.5):
+        """
+        Splits the GPS track into orchard rows: the images are taken in capture order, and a new row starts where the
+        heading turns away from the one of the current row or where the capture stops for a while.
+        :param max_turn: the change of heading, in degrees, which starts a new row.
+        :param max_gap: the seconds without images which start a new row.
+        :param min_step: the moves shorter than this, in meters, are too noisy to give a heading and are ignored.
+        :return: the row number of each image.
+        """
+        rows = np.zeros(len(self.timestamp), dtype=np.int64)
+        row = 0
+        heading = None
+        previous = None
+        for i in self.time_order:
+            if previous is not None:
+                step = math.hypot(self.x[i] - self.x[previous], self.y[i] - self.y[previous])
+                if self.timestamp[i] - self.timestamp[previous] > max_gap:
+                    row += 1
+                    heading = None
+                elif step >= min_step:
+                    direction = math.degrees(math.atan2(self.y[i] - self.y[previous], self.x[i] - self.x[previous]))
+                    if heading is None:
+                        heading = direction
+                    elif abs((direction - heading + 180.0) % 360.0 - 180.0) > max_turn:
+                        row += 1
+                        heading = direction
+            rows[i] = row
+            previous = i
+
+        return rows
+
+    def aggregate(self, indices):
+        """
+        Sums up the porosity of a set of images.
+        :param indices: the indices of the images, as returned by the queries.
+        :return: a dictionary with keys 'count', 'labels' (the threshold columns), 'mean', 'min', 'max' and 'std'
+        (one value per threshold column), 'latitude' and 'longitude' (the mean position), 'start' and 'end' (the first
+        and last capture times).
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices) == 0:
+            return {'count': 0, 'labels': self.labels}
+        porosity = self.porosity[indices]
+        return {'count': len(indices), 'labels': self.labels,
+                'mean': porosity.mean(axis=0), 'min': porosity.min(axis=0), 'max': porosity.max(axis=0),
+                'std': porosity.std(axis=0),
+                'latitude': float(self.latitude[indices].mean()), 'longitude': float(self.longitude[indices].mean()),
+                'start': float(self.timestamp[indices].min()), 'end': float(self.timestamp[indices].max())}
+
+    def aggregate_by(self, groups):
+        """
+        Sums up the porosity of each group of images.
+        :param groups: the group of each image, such as the rows of 'track_rows'.
+        :return: a list of tuples (group, aggregate), see 'aggregate', sorted by group.
+        """
+        groups = np.asarray(groups)
+        order = np.argsort(groups, kind='mergesort')
+        keys, starts = np.unique(groups[order], return_index=True)
+        stops = np.r_[starts[1:], len(order)]
+
+        return [(key, self.aggregate(order[start:stop])) for key, start, stop in zip(keys.tolist(), starts, stops)]
+
+    def aggregate_rows(self, **kwargs):
+        """
+        Sums up the porosity of each orchard row along the GPS track.
+        :param kwargs: the options of 'track_rows'.
+        :return: a list of tuples (row number, aggregate), see 'aggregate'.
+        """
+        return self.aggregate_by(self.track_rows(**kwargs))
+
+    def aggregate_blocks(self, block_size):
+        """
+        Sums up the porosity of each square block of the field.
+        :param block_size: the side of the blocks, in meters.
+        :return: a list of tuples ((column, row), aggregate), see 'aggregate'. The blocks are numbered from the center
+        of the images, eastwards and northwards.
+        """
+        cx, cy = self.cell_of(self.x, self.y, block_size)
+        # The block column and row are packed into one key to be grouped at once.
+        keys = (cx - cx.min()) * (cy.max() - cy.min() + 1) + (cy - cy.min()) if len(cx) else cx
+        blocks = dict((int(k), (int(i), int(j))) for k, i, j in zip(keys, cx, cy))
+
+        return [(blocks[key], aggregate) for key, aggregate in self.aggregate_by(keys)]
+
+
+def main():
+    """
+    Queries a results table from the command line.
+    :return: Nothing.
+    """
+    parser = argparse.ArgumentParser(description='Query the porosity results by position and capture time.')
+    parser.add_argument('results', help='the results.csv or results.npz file')
+    parser.add_argument('--near', nargs=3, type=float, metavar=('LAT', 'LON', 'RADIUS'),
+                        help='the images within RADIUS meters of a point')
+    parser.add_argument('--window', nargs=2, metavar=('START', 'END'),
+                        help='the images taken in a time window, written as yyyymmddHHMMSS')
+    parser.add_argument('--rows', action='store_true', help='the porosity of each orchard row along the GPS track')
+    parser.add_argument('--blocks', type=float, default=None, metavar='SIZE',
+                        help='the porosity of each square block of SIZE meters')
+    args = parser.parse_args()
+
+    index = GeoIndex.from_npz(args.results) if args.results.endswith('.npz') else GeoIndex.from_csv(args.results)
+    print 'Images indexed:', len(index.file_names)
+    groups = []
+    if args.near is not None:
+        groups.append(('near', index.aggregate(index.within_radius(*args.near))))
+    if args.window is not None:
+        start, end = [datetime.strptime(t, '%Y%m%d%H%M%S') for t in args.window]
+        groups.append(('window', index.aggregate(index.time_window(start, end))))
+    if args.rows:
+        groups += [('row {}'.format(row), aggregate) for row, aggregate in index.aggregate_rows()]
+    if args.blocks is not None:
+        groups += [('block {}'.format(block), aggregate) for block, aggregate in index.aggregate_blocks(args.blocks)]
+    for name, aggregate in groups:
+        print name, 'images:', aggregate['count']
+        if aggregate['count']:
+            for label, mean, std in zip(aggregate['labels'], aggregate['mean'], aggregate['std']):
+                print '    {:<30}{:.4f} +- {:.4f}'.format(label, mean, std)
+
+
+if __name__ == '__main__':
+    main()
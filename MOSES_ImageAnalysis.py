@@ -2,11 +2,33 @@
 # 
 
 import cv2
-import matplotlib.pyplot as plt
+import numpy as np
 import csv
+import os
+import sys
+from itertools import islice, izip
 from MOSES_UndistortImage import Undistort
+from MOSES_Parallel import batch_map, AsyncWriter
+from MOSES_Results import ResultsWriter
+from MOSES_Profiling import telemetry
+from MOSES_BufferPool import BufferPool, NO_BUFFERS
 from pprint import pprint as pp
 
+# Default thresholds of the analysis. The last one, above 1, selects no rectangle and gives the porosity compared with
+# Can-EYE.
+THRESHES = [0.40, 0.43, 0.45, 0.50, 0.55, 0.60, 0.65, 0.70, 0.75, 0.80, 0.85, 0.90, 0.95, 1.10]
+# Layout of the arrays of rectangles built by 'ImageAnalysis.build_grid'.
+GRID_DTYPE = np.dtype([('x1', np.int64), ('y1', np.int64), ('x2', np.int64), ('y2', np.int64)])
+# Gray level given by 'cv2.applyColorMap' with 'cv2.COLORMAP_OCEAN' followed by 'cv2.COLOR_BGR2GRAY' to each gray
+# level, used by 'ImageAnalysis.otsu_binarization' as a single lookup table.
+OCEAN_GRAY = cv2.cvtColor(cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(1, 256), cv2.COLORMAP_OCEAN),
+                          cv2.COLOR_BGR2GRAY).reshape(256)
+# Rows read above and below a band by the 5x5 blur of the binarization, see 'ImageAnalysis.measure_bands'.
+BLUR_MARGIN = 2
+# Bytes of working memory per pixel of a band, see 'ImageAnalysis.band_rows'.
+BAND_BYTES_PER_PIXEL = 8
+# Single precision epsilon, used as by OpenCV in the computation of the Otsu threshold.
+FLT_EPSILON = float(np.finfo(np.float32).eps)
 
 class ImageAnalysis(object):
     """
@@ -19,11 +41,21 @@ class ImageAnalysis(object):
         :param file_list: a list of the file names.
         :param kwargs: - 'sub_sampling_size': number of rows and columns which will form the analysis grid;
                        - 'rejection_area': width of the frame which will be excluded from the analysis, expressed as
-                       a percentage. For example 0.1 will exclude the outer 10% of each border
+                       a percentage. For example 0.1 will exclude the outer 10% of each border;
+                       - 'display': if True a panel showing the result of each threshold is saved for every image;
+                       - 'display_dir': the directory of the panels, 'directory/Display' by default;
+                       - 'display_format': the image format of the panels, such as 'png' (default) or 'jpg';
+                       - 'threshes': the thresholds of the analysis, 'THRESHES' by default;
+                       - 'results_name': the name of the results files, 'results' by default;
+                       - 'memory_budget': if given, the megabytes the working arrays of an image may take. A larger
+                       image is undistorted, binarized and counted by bands of rows, see 'measure_bands'. The budget
+                       does not cover the decoded image, which is held whole. None (whole images) by default;
+                       - 'mask_cache': a 'MaskCache' keeping the binarized images, which don't depend on the grid or
+                       the thresholds: the images found there are not decoded and binarized again. None by default.
         """
         self.directory = directory
         self.file_list = file_list
-        self.threshes = [0.40, 0.43, 0.45, 0.50, 0.55, 0.60, 0.65, 0.70, 0.75, 0.80, 0.85, 0.90, 0.95, 1.10]
+        self.threshes = list(kwargs['threshes']) if ('threshes' in kwargs.keys()) else list(THRESHES)
         # Setting up algorithm's parameters...
         self.sub_sampling_size = kwargs['sub_sampling_size'] if ('sub_sampling_size' in kwargs.keys()) else 10
         # Default value for sub_sampling_size if the value is too small or absent.
@@ -31,74 +63,287 @@ class ImageAnalysis(object):
             self.sub_sampling_size = 10
 
         rejection_area = kwargs['rejection_area'] if ('rejection_area' in kwargs.keys()) else 0
-        # Default value for rejection_area if the value is too small or absent.
-        if rejection_area is None or rejection_area < 0:
-            rejection_area = 0
-        if rejection_area > 0.3:
-            rejection_area = 0.3
-
-        self.rejection = int(self.sub_sampling_size * rejection_area)
+        self.rejection = self.rejection_cells(self.sub_sampling_size, rejection_area)
 
         self.display_results = kwargs['display'] if ('display' in kwargs.keys()) else False
+        # The threshold panels are saved as images in 'display_dir' instead of being shown in a blocking window.
+        self.display_dir = kwargs['display_dir'] if ('display_dir' in kwargs.keys()) else None
+        if self.display_dir is None:
+            self.display_dir = os.path.join(self.directory, 'Display')
+        self.display_format = kwargs['display_format'] if ('display_format' in kwargs.keys()) else 'png'
+        self.results_name = kwargs['results_name'] if ('results_name' in kwargs.keys()) else 'results'
+        self.memory_budget = kwargs['memory_budget'] if ('memory_budget' in kwargs.keys()) else None
+        self.mask_cache = kwargs['mask_cache'] if ('mask_cache' in kwargs.keys()) else None
+        # The working arrays of the analysis, reused from image to image.
+        self.buffers = BufferPool()
 
     @staticmethod
-    def otsu_binarization(img):
+    def otsu_binarization(img, buffers=NO_BUFFERS):
         """
         Performs the binarization of an image using Otsu algorithm.
         :param img: the image.
+        :param buffers: the 'BufferPool' of the working arrays. By default the binarized image is an array of its own;
+        with a pool it is overwritten by the next image.
+        :return: the binarized image.
+        """
+        with telemetry.stage('binarize', pixels=img.shape[0] * img.shape[1]):
+            blur = cv2.GaussianBlur(img, (5, 5), 0, dst=buffers.like('blur', img))
+            img_otsu = cv2.LUT(blur, ImageAnalysis.binarization_table(ImageAnalysis.gray_histogram(blur)),
+                               dst=buffers.like('binarized', blur))
+
+        return img_otsu
+
+    @staticmethod
+    def binarization_table(hist):
+        """
+        Computes the lookup table which binarizes a blurred image, given the histogram of the whole blurred image.
+        :param hist: the 256 pixel counts of the blurred image.
+        :return: the lookup table, 255 for the gray levels above the Otsu threshold and 0 for the others.
+        """
+        # The color map followed by the conversion to gray maps each gray level to another one: the histogram of
+        # the remapped image is the histogram of the blurred one, gathered through 'OCEAN_GRAY'.
+        remapped_hist = np.bincount(OCEAN_GRAY, weights=hist, minlength=256).astype(np.int64)
+        thresh = ImageAnalysis.otsu_threshold(remapped_hist)
+
+        return np.where(OCEAN_GRAY > thresh, 255, 0).astype(np.uint8)
+
+    @staticmethod
+    def reference_binarization(img):
+        """
+        Performs the binarization as 'otsu_binarization' through the 3-channel color map, as it was first written.
+        Slower; kept to check that both give the same image.
+        :param img: the image.
         :return: the binarized image.
         """
         blur = cv2.GaussianBlur(img, (5, 5), 0)
-        remapped = cv2.applyColorMap(blur, cv2.COLORMAP_OCEAN) 
+        remapped = cv2.applyColorMap(blur, cv2.COLORMAP_OCEAN)
         remapped = cv2.cvtColor(remapped, cv2.COLOR_BGR2GRAY)
         ret, img_otsu = cv2.threshold(remapped, 0, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU)
 
         return img_otsu
 
-    def rejection_grid(self, img):
+    @staticmethod
+    def gray_histogram(img):
         """
-        Builds a list containing rectangles, described by regards of their side position.
-        The rectangles on the border of the image are excluded according to rejection_area's value.
+        Counts the pixels of each gray level of an 8 bit image. 'cv2.calcHist' counts in single precision, exact only
+        up to 2^24: the image is counted by bands of rows small enough for that.
         :param img: the image.
-        :return: -grid: list of rectangles.
+        :return: the 256 pixel counts.
+        """
+        rows = max(1, (1 << 24) // max(1, img.shape[1]))
+        hist = np.zeros(256, dtype=np.int64)
+        for y in xrange(0, img.shape[0], rows):
+            hist += cv2.calcHist([img[y:y + rows]], [0], None, [256], [0, 256]).ravel().astype(np.int64)
+
+        return hist
+
+    @staticmethod
+    def otsu_threshold(hist):
+        """
+        Computes the Otsu threshold of an 8 bit image from its histogram. The computation is the one of OpenCV
+        'cv2.threshold' with 'cv2.THRESH_OTSU', in the same order, so that the threshold is the same.
+        :param hist: the 256 pixel counts.
+        :return: the threshold: the pixels above it are white.
+        """
+        total = int(np.sum(hist))
+        if total == 0:
+            return 0
+        hist = [int(h) for h in hist]
+        scale = 1.0 / total
+        mu = 0.0
+        for i in xrange(256):
+            mu += i * float(hist[i])
+        mu *= scale
+        mu1 = 0.0
+        q1 = 0.0
+        max_sigma = 0.0
+        max_val = 0
+        for i in xrange(256):
+            p_i = hist[i] * scale
+            mu1 *= q1
+            q1 += p_i
+            q2 = 1.0 - q1
+            if min(q1, q2) < FLT_EPSILON or max(q1, q2) > 1.0 - FLT_EPSILON:
+                continue
+            mu1 = (mu1 + i * p_i) / q1
+            mu2 = (mu - q1 * mu1) / q2
+            sigma = q1 * q2 * (mu1 - mu2) * (mu1 - mu2)
+            if sigma > max_sigma:
+                max_sigma = sigma
+                max_val = i
+
+        return max_val
+
+    @staticmethod
+    def rejection_cells(sub_sampling_size, rejection_area):
+        """
+        Converts the rejection area into the number of rows and columns of the grid excluded on each border.
+        :param sub_sampling_size: number of rows and columns of the grid.
+        :param rejection_area: width of the excluded frame, expressed as a percentage.
+        :return: the number of excluded rows and columns.
+        """
+        # Default value for rejection_area if the value is too small or absent.
+        if rejection_area is None or rejection_area < 0:
+            rejection_area = 0
+        if rejection_area > 0.3:
+            rejection_area = 0.3
+
+        return int(sub_sampling_size * rejection_area)
+
+    @staticmethod
+    def build_grid(shape, sub_sampling_size, rejection):
+        """
+        Builds the array of the rectangles of the grid, described by regards of their side position. The rectangles on
+        the border of the image are excluded according to the number of rejected rows and columns.
+        :param shape: the shape of the image.
+        :param sub_sampling_size: number of rows and columns of the grid.
+        :param rejection: number of rows and columns excluded on each border.
+        :return: -grid: a structured array of rectangles with fields 'x1', 'y1', 'x2', 'y2'. The rectangles are ordered
+                 by column, then by row.
                  -aoi: (area of interest)the rectangle containing all of the elements of grid where the analysis will
                  be actuated.
         """
-        h, w = img.shape[:2]
-        dw = int(w / self.sub_sampling_size)
-        dh = int(h / self.sub_sampling_size)
-        grid = []
-        for x in xrange(self.rejection, self.sub_sampling_size - self.rejection):
-            for y in xrange(self.rejection, self.sub_sampling_size - self.rejection):
-                # Defining the coordinates of every rectangle made inside the image excluding the border
-                # side according to the 'rejection_area' value.
-                d = dict()
-                d['x1'] = dw * x
-                d['x2'] = dw * (x + 1)
-                d['y1'] = dh * y
-                d['y2'] = dh * (y + 1)
-                if x == self.sub_sampling_size - 1:
-                    d['x2'] = w
-                if y == self.sub_sampling_size - 1:
-                    d['y2'] = h
-                grid.append(d)
+        h, w = shape[:2]
+        dw = int(w / sub_sampling_size)
+        dh = int(h / sub_sampling_size)
+        cells = np.arange(rejection, sub_sampling_size - rejection)
+        x, y = [c.ravel() for c in np.meshgrid(cells, cells, indexing='ij')]
+        grid = np.empty(len(x), GRID_DTYPE)
+        grid['x1'] = dw * x
+        grid['y1'] = dh * y
+        # The last column and row extend to the border of the image.
+        grid['x2'] = np.where(x == sub_sampling_size - 1, w, dw * (x + 1))
+        grid['y2'] = np.where(y == sub_sampling_size - 1, h, dh * (y + 1))
 
         aoi = dict()
         # Defines a dictionary which contains the coordinates of the 'aoi' (area of interest),
         # where the analysis will be performed.
-        aoi['x1'] = grid[0]['x1']
-        aoi['y1'] = grid[0]['y1']
-        aoi['x2'] = grid[len(grid) - 1]['x2']
-        aoi['y2'] = grid[len(grid) - 1]['y2']
-        print 'total_px = ', img.size
+        aoi['x1'] = int(grid[0]['x1'])
+        aoi['y1'] = int(grid[0]['y1'])
+        aoi['x2'] = int(grid[-1]['x2'])
+        aoi['y2'] = int(grid[-1]['y2'])
+
+        return grid, aoi
+
+    def rejection_grid(self, img):
+        """
+        Builds the array of the rectangles of the analysis grid, see 'build_grid'.
+        The rectangles on the border of the image are excluded according to rejection_area's value.
+        :param img: the image.
+        :return: -grid: array of rectangles.
+                 -aoi: (area of interest)the rectangle containing all of the elements of grid where the analysis will
+                 be actuated.
+        """
+        return self.shape_grid(img.shape)
+
+    def shape_grid(self, shape):
+        """
+        Builds the analysis grid of an image from its shape only, see 'rejection_grid'.
+        :param shape: the shape of the image.
+        :return: the same results as 'rejection_grid'.
+        """
+        grid, aoi = self.build_grid(shape, self.sub_sampling_size, self.rejection)
+        total_px = shape[0] * shape[1]
+        print 'total_px = ', total_px
         print 'aoi =', (aoi['x2']-aoi['x1'])*(aoi['y2']-aoi['y1'])
-        print 'rejection_area =', img.size - (aoi['x2']-aoi['x1'])*(aoi['y2']-aoi['y1'])
+        print 'rejection_area =', total_px - (aoi['x2']-aoi['x1'])*(aoi['y2']-aoi['y1'])
 
         return grid, aoi
 
+    @staticmethod
+    def integral_image(binarized, buffers=NO_BUFFERS):
+        """
+        Computes the integral image of the white pixels of a binarized image: the number of white pixels of any
+        rectangle can then be read from its four corners.
+        :param binarized: the binarized image.
+        :param buffers: the 'BufferPool' of the working arrays, see 'otsu_binarization'.
+        :return: the integral image, one row and one column larger than the image, in 32 bit: enough for images of up
+        to 2^31 pixels.
+        """
+        h, w = binarized.shape[:2]
+        with telemetry.stage('grid_count', pixels=h * w):
+            white = cv2.threshold(binarized, 0, 1, cv2.THRESH_BINARY, dst=buffers.like('white', binarized))[1]
+            return cv2.integral(white, sum=buffers.get('integral', (h + 1, w + 1), np.int32), sdepth=cv2.CV_32S)
+
+    @staticmethod
+    def cell_sums(integral, grid):
+        """
+        Reads the number of white pixels of every rectangle of grid from the integral image.
+        :param integral: the integral image obtained by 'integral_image'.
+        :param grid: the array of rectangles.
+        :return: - an array with the number of white pixels of each rectangle;
+                 - an array with the area of each rectangle.
+        """
+        x1, y1, x2, y2 = grid['x1'], grid['y1'], grid['x2'], grid['y2']
+        white = integral[y2, x2].astype(np.int64) - integral[y1, x2] - integral[y2, x1] + integral[y1, x1]
+
+        return white, (y2 - y1) * (x2 - x1)
+
+    def cell_white_counts(self, binarized, grid):
+        """
+        Counts the white pixels of every rectangle of grid in a single pass, reading the sums from the integral image
+        of the binarized image instead of scanning each rectangle.
+        :param binarized: the binarized image.
+        :param grid: the array of rectangles.
+        :return: - an array with the number of white pixels of each rectangle;
+                 - an array with the area of each rectangle.
+        """
+        return self.cell_sums(self.integral_image(binarized, self.buffers), grid)
+
+    def crown_counts(self, binarized, grid, aoi, threshes=None):
+        """
+        Computes the number of pixel of the crown for every threshold at once. Each rectangle whose ratio between white
+        pixels and surface is bigger than a threshold is considered large gap (sky) for that threshold, and its white
+        pixels are not part of the crown.
+        :param binarized: the binarized image.
+        :param grid: the lists of rectangles.
+        :param aoi: the rectangular area which contains every element of grid.
+        :param threshes: the thresholds required for the analysis. 'self.threshes' if None.
+        :return: - an array with the number of pixel of the crown (both black and white) for each threshold;
+                 - a boolean array (thresholds x rectangles) flagging the rectangles classified as large gap.
+        """
+        white, area = self.cell_white_counts(binarized, grid)
+
+        return self.crown_counts_from_cells(white, area, (aoi['x2'] - aoi['x1']) * (aoi['y2'] - aoi['y1']), threshes)
+
+    def crown_counts_from_cells(self, white, area, aoi_area, threshes=None):
+        """
+        Computes the number of pixel of the crown for every threshold from the white pixel counts of the rectangles.
+        :param white: the number of white pixels of each rectangle, as returned by 'cell_white_counts'.
+        :param area: the area of each rectangle.
+        :param aoi_area: the area of the 'aoi'.
+        :param threshes: the thresholds required for the analysis. 'self.threshes' if None.
+        :return: the same results as 'crown_counts'.
+        """
+        if threshes is None:
+            threshes = self.threshes
+        white = np.asarray(white, dtype=np.int64)
+        ratio = white / np.asarray(area, dtype=np.float64)
+        large_gap = ratio[np.newaxis, :] > np.asarray(threshes, dtype=np.float64)[:, np.newaxis]
+        large_gap_pix = np.dot(large_gap, white)
+
+        return aoi_area - large_gap_pix, large_gap
+
+    @staticmethod
+    def sky_gap_overlay(binarized, grid, large_gap):
+        """
+        Creates a copy of the binarized image which has all the pixel of the large gap (sky) highlighted in gray.
+        :param binarized: the binarized image.
+        :param grid: the lists of rectangles.
+        :param large_gap: the flags of the rectangles classified as large gap, one for each element of grid.
+        :return: the highlighted image.
+        """
+        # The grid has at most 'sub_sampling_size' squared rectangles: each selected one is painted in place, without
+        # any array of the size of the image but the copy.
+        display = binarized.copy()
+        for cell in grid[np.asarray(large_gap, dtype=bool)]:
+            view = display[cell['y1']:cell['y2'], cell['x1']:cell['x2']]
+            view[view == 255] = 128
+        return display
+
     def crown_count(self, img, thresh, grid, aoi):
         """
-        Computes the number of pixel of the crown.
+        Computes the number of pixel of the crown for a single threshold.
         :param img: the image.
         :param thresh: the threshold required for the analysis.
         :param grid: the lists of rectangles.
@@ -108,30 +353,11 @@ class ImageAnalysis(object):
                  is false
         """
         binarized = self.otsu_binarization(img)
-        display = 0
-        if self.display_results:
-            display = binarized.copy()
-        large_gap_pix = 0
-        for roi in grid:
-            # Counting the number of white pixel contained in each reagion of interest.
-            area = (roi['y2'] - roi['y1']) * (roi['x2'] - roi['x1'])
-            wp = cv2.countNonZero(binarized[
-                                  roi['y1']:roi['y2'],
-                                  roi['x1']:roi['x2']])
-            if (float(wp) / float(area)) > thresh:
-                # If the ratio between the white pixel and the surface of the rectangle is bigger than the
-                # threshold, the count of white pixel for that specific rectangle is added to large_gap_pix
-                large_gap_pix = large_gap_pix + wp
-                if self.display_results:
-                    # Create a copy of the image highlighting the selected pixel.
-                    for x in xrange(roi['x1'], roi['x2']):
-                        for y in xrange(roi['y1'], roi['y2']):
-                            if binarized[y, x] == 255:
-                                display[y, x] = 128
+        crown_pix, large_gap = self.crown_counts(binarized, grid, aoi, [thresh])
         if self.display_results:
-            return (aoi['x2']-aoi['x1'])*(aoi['y2']-aoi['y1']) - large_gap_pix, display
+            return int(crown_pix[0]), self.sky_gap_overlay(binarized, grid, large_gap[0])
         else:
-            return (aoi['x2'] - aoi['x1']) * (aoi['y2'] - aoi['y1']) - large_gap_pix, None
+            return int(crown_pix[0]), None
 
     @staticmethod
     def count_black_pixel(img, aoi):
@@ -153,37 +379,90 @@ class ImageAnalysis(object):
         :param aoi: the rectangle containing all of the elements of grid where the analysis will be actuated.
         :return: a list that contain all the calculated fraction cover '(leaf_pix / float(crown_pix))'.
         """
+        return self.compute_results_binarized(bp, self.otsu_binarization(img), grid, aoi)
+
+    def compute_results_binarized(self, bp, binarized, grid, aoi):
+        """
+        Same as 'compute_results', for an image already binarized by 'otsu_binarization'.
+        :param bp: the number of black pixel contained in the image's 'aoi'.
+        :param binarized: the binarized image.
+        :param grid: the list of rectangle obtained by 'rejection_grid'.
+        :param aoi: the rectangle containing all of the elements of grid where the analysis will be actuated.
+        :return: a list that contain all the calculated fraction cover '(leaf_pix / float(crown_pix))'.
+        """
+        # The number of crown pixel is computed for all the thresholds in a single pass over the binarized image.
+        crown_pixels, large_gap = self.crown_counts(binarized, grid, aoi)
+
+        return self.fraction_covers(bp, crown_pixels)
+
+    @staticmethod
+    def fraction_covers(bp, crown_pixels):
+        """
+        Computes the fraction cover of each threshold.
+        :param bp: the number of black pixel contained in the image's 'aoi'.
+        :param crown_pixels: the number of pixel of the crown for each threshold.
+        :return: a list that contain all the calculated fraction cover '(leaf_pix / float(crown_pix))'.
+        """
         leaf_pix = float(bp)
         fraction_cover = []
-        d_list = []
-        for t in self.threshes:
-            # For each threshold will be computed:
-            #    - the number of crown pixel calculated;
-            #    - the list of fraction cover calculated;
-            #    - the list of coordinates needed for the displaying.
-            crown_pix, display = self.crown_count(img, t, grid, aoi)
-            if crown_pix == 0.0:
+        for crown_pix in crown_pixels:
+            if crown_pix == 0:
                 fraction_cover.append("0.00")
             else:
                 fraction_cover.append(leaf_pix / float(crown_pix))
-                    
-            d_list.append(display)
-        if self.display_results:
-            # If 'display_results' is true it will be created a windows that contains a picture for each threshold
-            # value, showing the algorithm result. The gray pixel are the one identified as part of the sky
-            for i in xrange(4):
-                for j in xrange(1, 5):
-                    if i * 4 + j - 1 >= len(d_list):
-                        continue
-                    plt.subplot(4, 4, i * 4 + j)
-                    plt.imshow(d_list[i * 4 + j - 1], 'gray')
-                    plt.title(self.threshes[i * 4 + j - 1])
-                    plt.xticks([]), plt.yticks([])
-            plt.subplots_adjust(bottom=0, left=0.01, right=0.99,
-                                top=0.99, wspace=0.01, hspace=0.01)
-            plt.show()
+
         return fraction_cover
 
+    def fraction_cover_from_cells(self, measurement):
+        """
+        Computes the fraction cover of each threshold from the counts of 'measure_array', without the image.
+        :param measurement: the dictionary returned by 'measure_array'.
+        :return: a list that contain all the calculated fraction cover '(leaf_pix / float(crown_pix))'.
+        """
+        crown_pixels, large_gap = self.crown_counts_from_cells(measurement['white'], measurement['area'],
+                                                               measurement['aoi_area'])
+        return self.fraction_covers(measurement['leaf_pix'], crown_pixels)
+
+    @staticmethod
+    def porosity_curve_from_cells(measurement, threshes):
+        """
+        Computes the porosity as a function of the threshold, for any number of thresholds. The rectangles are sorted
+        once by white ratio: the large gap pixels of a threshold are then the sum of the white pixels of the rectangles
+        after it in the sorted order, read from a cumulative sum. The cost barely depends on the number of thresholds.
+        :param measurement: the dictionary returned by 'measure_array'.
+        :param threshes: the thresholds of the curve.
+        :return: an array with the porosity of each threshold, computed as in the '.csv' table.
+        """
+        white = np.asarray(measurement['white'], dtype=np.int64)
+        ratio = white / np.asarray(measurement['area'], dtype=np.float64)
+        order = np.argsort(ratio, kind='mergesort')
+        sorted_ratio = ratio[order]
+        # gap_after[k] is the number of white pixels of the rectangles from position k of the sorted order onwards.
+        gap_after = np.zeros(len(white) + 1, np.int64)
+        gap_after[:-1] = np.cumsum(white[order][::-1])[::-1]
+        large_gap_pix = gap_after[np.searchsorted(sorted_ratio, np.asarray(threshes, dtype=np.float64), 'right')]
+        crown_pix = measurement['aoi_area'] - large_gap_pix
+
+        fraction_cover = np.zeros(len(crown_pix))
+        covered = crown_pix != 0
+        fraction_cover[covered] = float(measurement['leaf_pix']) / crown_pix[covered]
+        return np.where(fraction_cover == 0, 0, 1 - fraction_cover)
+
+    def porosity_curve(self, measurement, threshes=None, samples=1000):
+        """
+        Computes the porosity curve of an image, see 'porosity_curve_from_cells'.
+        :param measurement: the dictionary returned by 'measure_array'.
+        :param threshes: the thresholds of the curve. If None, 'samples' thresholds evenly spaced between 0 and 1.
+        :param samples: the number of thresholds when 'threshes' is None.
+        :return: - the thresholds;
+                 - an array with the porosity of each threshold.
+        """
+        if threshes is None:
+            threshes = np.linspace(0, 1, samples)
+        threshes = np.asarray(threshes, dtype=np.float64)
+
+        return threshes, self.porosity_curve_from_cells(measurement, threshes)
+
     def analyze_image(self, file_path):
         """
         Performs the analysis of a single image.
@@ -193,72 +472,455 @@ class ImageAnalysis(object):
                  - 'leaf_pix': the number of black pixels that represent the foliage cover.
         """
         print 'Analysing: ', file_path
-        img = cv2.imread(file_path, cv2.IMREAD_GRAYSCALE)
-        grid, aoi = self.rejection_grid(img)
-        img_otsu = self.otsu_binarization(img)
-        leaf_pix = self.count_black_pixel(img_otsu, aoi)
-        fraction_cover = self.compute_results(leaf_pix, img, grid, aoi)
+        img = Undistort.read_image(file_path, cv2.IMREAD_GRAYSCALE)
+
+        return self.analyze_array(img, file_path)
+
+    def analyze_array(self, img, file_path):
+        """
+        Performs the analysis of a single image already loaded in memory.
+        :param img: the grayscale image.
+        :param file_path: the path the image comes from, used to name the threshold panel.
+        :return: the same results as 'analyze_image'.
+        """
+        measurement = self.measure_array(img, file_path)
+
+        return self.fraction_cover_from_cells(measurement), measurement['leaf_pix']
+
+    def measure_image(self, file_path):
+        """
+        Performs the pixel counts of a single image.
+        :param file_path: the file path
+        :return: the same results as 'measure_array'.
+        """
+        return self.measure_decoded(self.decode_image(file_path), file_path)
+
+    def mask_key(self, file_path, calibration=None, reduction=1):
+        """
+        Gets the key of the binarized image of a file in 'mask_cache', see 'MaskCache.key'.
+        :param file_path: the image file path.
+        :param calibration: the calibration signature, None if the image is not undistorted.
+        :param reduction: the factor the image is reduced by when decoded.
+        :return: the key, None without 'mask_cache'.
+        """
+        if self.mask_cache is None:
+            return None
+        return self.mask_cache.key(file_path, calibration, reduction)
+
+    def cached_mask(self, mask_key):
+        """
+        Reads a binarized image from 'mask_cache'.
+        :param mask_key: the key returned by 'mask_key'.
+        :return: the binarized image, None if it is not in the cache.
+        """
+        if mask_key is None:
+            return None
+        return self.mask_cache.get(mask_key)
+
+    def binarize_cached(self, img, mask_key=None):
+        """
+        Binarizes an image, see 'otsu_binarization', and keeps the result in 'mask_cache'.
+        :param img: the grayscale image.
+        :param mask_key: the key returned by 'mask_key', None not to keep the result.
+        :return: the binarized image, in a buffer of 'self.buffers'.
+        """
+        img_otsu = self.otsu_binarization(img, self.buffers)
+        if mask_key is not None:
+            self.mask_cache.put(mask_key, img_otsu)
+
+        return img_otsu
+
+    def decode_image(self, file_path):
+        """
+        Decodes an image in grayscale, unless its binarized image is in 'mask_cache'.
+        :param file_path: the file path.
+        :return: a tuple (image, mask): either the grayscale image and None, or None and the binarized image.
+        """
+        mask = self.cached_mask(self.mask_key(file_path))
+        if mask is not None:
+            return None, mask
+        return Undistort.read_image(file_path, cv2.IMREAD_GRAYSCALE), None
+
+    def measure_decoded(self, decoded, file_path):
+        """
+        Performs the pixel counts of an image decoded by 'decode_image'.
+        :param decoded: the tuple (image, mask) returned by 'decode_image'.
+        :param file_path: the file path.
+        :return: the same results as 'measure_array'.
+        """
+        print 'Analysing: ', file_path
+        img, mask = decoded
+        if mask is not None:
+            return self.measure_binarized(mask, file_path)
+
+        return self.measure_array(img, file_path, self.mask_key(file_path))
+
+    def measure_array(self, img, file_path, mask_key=None):
+        """
+        Performs the pixel counts of a single image already loaded in memory. They depend on 'sub_sampling_size' and
+        'rejection_area' only: the fraction cover of any threshold can be derived from them by
+        'fraction_cover_from_cells'.
+        :param img: the grayscale image. It may be a memory-mapped array: with 'memory_budget' only a band of its rows
+        is read at a time.
+        :param file_path: the path the image comes from, used to name the threshold panel.
+        :param mask_key: if given, the binarized image is kept in 'mask_cache' with this key, see 'mask_key'. The
+        images processed by bands are not kept.
+        :return: a dictionary with keys:
+                 - 'leaf_pix': the number of black pixels that represent the foliage cover;
+                 - 'white': an array with the number of white pixels of each rectangle of the grid;
+                 - 'area': an array with the area of each rectangle of the grid;
+                 - 'aoi_area': the area of the 'aoi'.
+        """
+        if self.band_rows(img.shape[1]) < img.shape[0]:
+            return self.measure_bands(lambda first, last: img[first:last], img.shape, file_path)
+
+        return self.measure_binarized(self.binarize_cached(img, mask_key), file_path)
+
+    def measure_binarized(self, img_otsu, file_path):
+        """
+        Performs the pixel counts of an image already binarized, such as one read from 'mask_cache'.
+        :param img_otsu: the binarized image.
+        :param file_path: the path the image comes from, used to name the threshold panel.
+        :return: the same results as 'measure_array'.
+        """
+        grid, aoi = self.rejection_grid(img_otsu)
+        white, area = self.cell_white_counts(img_otsu, grid)
+        if self.display_results:
+            with telemetry.stage('display'):
+                aoi_area = (aoi['x2'] - aoi['x1']) * (aoi['y2'] - aoi['y1'])
+                large_gap = self.crown_counts_from_cells(white, area, aoi_area)[1]
+                self.save_threshold_panel(self.sky_gap_overlays(img_otsu, grid, aoi, large_gap), file_path)
+
+        return {'leaf_pix': self.count_black_pixel(img_otsu, aoi), 'white': white, 'area': area,
+                'aoi_area': (aoi['x2'] - aoi['x1']) * (aoi['y2'] - aoi['y1'])}
+
+    def band_rows(self, width, read_bytes_per_pixel=0):
+        """
+        Gets the number of rows of the bands the images are processed by, see 'measure_bands'.
+        :param width: the image width.
+        :param read_bytes_per_pixel: the bytes per pixel taken to read the rows of a band, such as those of its
+        undistortion, on top of the rows read.
+        :return: the number of rows which fit 'memory_budget', at least one.
+        """
+        if self.memory_budget is None:
+            return sys.maxint
+        # Working memory per pixel of a band: the source, the blurred and the binarized rows and the mask of white
+        # pixels, 1 byte each, and its 32 bit integral image, 4 bytes.
+        bytes_per_pixel = BAND_BYTES_PER_PIXEL + read_bytes_per_pixel
+        return max(1, int(self.memory_budget * 1024 * 1024) // (bytes_per_pixel * width) - 2 * BLUR_MARGIN)
+
+    def blurred_band(self, read_rows, height, first, last):
+        """
+        Blurs a band of rows of an image. The rows above and below it that the blur reaches are read too, so the band
+        is the same as in the blurred whole image.
+        :param read_rows: a function which gets the rows 'first' to 'last' (excluded) of the grayscale image.
+        :param height: the image height.
+        :param first: the first row of the band.
+        :param last: the row after the last one of the band.
+        :return: the blurred rows of the band.
+        """
+        top = max(0, first - BLUR_MARGIN)
+        bottom = min(height, last + BLUR_MARGIN)
+        rows = np.ascontiguousarray(read_rows(top, bottom))
+        blur = cv2.GaussianBlur(rows, (5, 5), 0, dst=self.buffers.like('band_blur', rows))
+
+        return blur[first - top: last - top]
+
+    def measure_bands(self, read_rows, shape, file_path, read_bytes_per_pixel=0):
+        """
+        Performs the pixel counts of an image band by band, so that the working arrays stay within 'memory_budget'
+        whatever the image size. What 'read_rows' reads from, such as the decoded image, is not covered. A first pass
+        gathers the histogram of the whole blurred image, from which the global Otsu threshold is computed; a second
+        pass binarizes each band and adds up its counts. The results are the same as those of the whole image; the
+        threshold panels, which need the whole binarized image, are not drawn unless the image fits in a single band.
+        :param read_rows: a function which gets the rows 'first' to 'last' (excluded) of the grayscale image, such as
+        a slice of a memory-mapped array or 'Undistort.undistort_gray_rows'.
+        :param shape: the shape of the image.
+        :param file_path: the path the image comes from.
+        :param read_bytes_per_pixel: the bytes per pixel 'read_rows' takes on top of the rows it returns, see
+        'band_rows'.
+        :return: the same results as 'measure_array'.
+        """
+        height, width = shape[:2]
+        rows = self.band_rows(width, read_bytes_per_pixel)
+        if rows >= height:
+            return self.measure_array(read_rows(0, height), file_path)
+        grid, aoi = self.shape_grid(shape)
+        bands = [(first, min(first + rows, height)) for first in xrange(0, height, rows)]
+        with telemetry.stage('binarize', pixels=height * width):
+            hist = np.zeros(256, dtype=np.int64)
+            for first, last in bands:
+                hist += self.gray_histogram(self.blurred_band(read_rows, height, first, last))
+            table = self.binarization_table(hist)
+
+        white = np.zeros(len(grid), dtype=np.int64)
+        white_aoi = 0
+        band_grid = grid.copy()
+        for first, last in bands:
+            with telemetry.stage('binarize', pixels=(last - first) * width):
+                blur = self.blurred_band(read_rows, height, first, last)
+                img_otsu = cv2.LUT(blur, table, dst=self.buffers.like('band_binarized', blur))
+            # The rectangles are clipped to the band: those outside of it get no rows, hence no white pixels.
+            band_grid['y1'] = np.clip(grid['y1'] - first, 0, last - first)
+            band_grid['y2'] = np.clip(grid['y2'] - first, 0, last - first)
+            white += self.cell_sums(self.integral_image(img_otsu, self.buffers), band_grid)[0]
+            y1 = min(max(aoi['y1'] - first, 0), last - first)
+            y2 = min(max(aoi['y2'] - first, 0), last - first)
+            if y2 > y1:
+                white_aoi += cv2.countNonZero(img_otsu[y1:y2, aoi['x1']:aoi['x2']])
+
+        aoi_area = (aoi['x2'] - aoi['x1']) * (aoi['y2'] - aoi['y1'])
+        return {'leaf_pix': aoi_area - white_aoi, 'white': white,
+                'area': (grid['y2'] - grid['y1']) * (grid['x2'] - grid['x1']), 'aoi_area': aoi_area}
+
+    def grid_parameters(self):
+        """
+        Gets the parameters the pixel counts of 'measure_array' depend on.
+        :return: a dictionary with keys 'sub_sampling_size' and 'rejection' (the number of excluded rows and columns).
+        """
+        return {'sub_sampling_size': self.sub_sampling_size, 'rejection': self.rejection}
+
+    def measure_grids(self, img, configurations):
+        """
+        Performs the pixel counts of an image for several grids at once. The image is binarized and integrated once,
+        then each grid only reads its rectangles from the shared integral image.
+        :param img: the grayscale image.
+        :param configurations: a list of (sub_sampling_size, rejection_area) pairs.
+        :return: a list with the dictionary of 'measure_array' of each configuration.
+        """
+        return self.measure_grids_binarized(self.otsu_binarization(img, self.buffers), configurations)
+
+    def measure_grids_binarized(self, img_otsu, configurations):
+        """
+        Performs the pixel counts of an image already binarized for several grids, see 'measure_grids'.
+        :param img_otsu: the binarized image.
+        :param configurations: a list of (sub_sampling_size, rejection_area) pairs.
+        :return: the same results as 'measure_grids'.
+        """
+        integral = self.integral_image(img_otsu, self.buffers)
+        measurements = []
+        for sub_sampling_size, rejection_area in configurations:
+            grid, aoi = self.build_grid(img_otsu.shape, sub_sampling_size,
+                                        self.rejection_cells(sub_sampling_size, rejection_area))
+            white, area = self.cell_sums(integral, grid)
+            aoi_area = (aoi['x2'] - aoi['x1']) * (aoi['y2'] - aoi['y1'])
+            aoi_white = (integral[aoi['y2'], aoi['x2']] - integral[aoi['y1'], aoi['x2']] -
+                         integral[aoi['y2'], aoi['x1']] + integral[aoi['y1'], aoi['x1']])
+            measurements.append({'leaf_pix': int(aoi_area - aoi_white), 'white': white, 'area': area,
+                                 'aoi_area': aoi_area})
+
+        return measurements
+
+    def measure_image_grids(self, job):
+        """
+        Performs the pixel counts of a single image for several grids, see 'measure_grids'.
+        :param job: a tuple (file path, configurations), the form in which 'analyse_grids' hands out the images.
+        :return: the same results as 'measure_grids'.
+        """
+        file_path, configurations = job
+        print 'Analysing: ', file_path
+        img, mask = self.decode_image(file_path)
+        if mask is None:
+            mask = self.binarize_cached(img, self.mask_key(file_path))
+
+        return self.measure_grids_binarized(mask, configurations)
+
+    def grid_configuration(self, sub_sampling_size, rejection_area):
+        """
+        Creates an analysis with the same directory, images and thresholds, but another grid. Its results are saved as
+        'results_<sub_sampling_size>_<rejection_area>'.
+        :param sub_sampling_size: number of rows and columns of the grid.
+        :param rejection_area: width of the excluded frame, expressed as a percentage.
+        :return: the new 'ImageAnalysis' object.
+        """
+        return ImageAnalysis(self.directory, self.file_list, sub_sampling_size=sub_sampling_size,
+                             rejection_area=rejection_area, threshes=self.threshes, mask_cache=self.mask_cache,
+                             results_name='{}_{}_{:g}'.format(self.results_name, sub_sampling_size, rejection_area))
+
+    def analyse_grids(self, configurations, jobs=1):
+        """
+        Performs the analysis of all the images for several grids in one pass over the data: every image is decoded
+        and binarized once, and the results of each grid are saved in their own '.csv' table.
+        :param configurations: a list of (sub_sampling_size, rejection_area) pairs.
+        :param jobs: the number of processes analysing the images in parallel, 0 to use all the cores.
+        :return: the list of the '.csv' file paths, one for each configuration.
+        """
+        analyses = [self.grid_configuration(n, a) for n, a in configurations]
+        writers = [ResultsWriter(analysis) for analysis in analyses]
+        for writer in writers:
+            writer.open()
+        try:
+            grid_jobs = [(self.directory+f, configurations) for f in self.file_list]
+            for i, (job, measurements, error) in enumerate(batch_map(self, 'measure_image_grids', grid_jobs, jobs)):
+                f = self.file_list[i]
+                if error is not None:
+                    print 'ERROR: analysis of', f, 'failed:', error
+                    continue
+                for writer, measurement in zip(writers, measurements):
+                    writer.write(f, measurement)
+        finally:
+            for writer in writers:
+                writer.close()
+
+        return [analysis.results_path() for analysis in analyses]
+
+    def sky_gap_overlays(self, binarized, grid, aoi, large_gap=None):
+        """
+        Creates, for each threshold, a copy of the binarized image which has the pixel identified as part of the sky
+        highlighted in gray.
+        :param binarized: the binarized image.
+        :param grid: the list of rectangle obtained by 'rejection_grid'.
+        :param aoi: the rectangle containing all of the elements of grid where the analysis will be actuated.
+        :param large_gap: the large gap flags of 'crown_counts', if already known: they are otherwise computed from
+        the image.
+        :return: an iterator over the images, one for each element of 'self.threshes'. Each one is created when the
+        previous one has been used, so that only one is held at a time.
+        """
+        if large_gap is None:
+            crown_pixels, large_gap = self.crown_counts(binarized, grid, aoi)
+        for gap in large_gap:
+            yield self.sky_gap_overlay(binarized, grid, gap)
+
+    def threshold_panel(self, overlays):
+        """
+        Draws a 4x4 panel that contains a picture for each threshold value, showing the algorithm result. The figure
+        is rendered off-screen, so it never blocks the analysis. Each image is shrunk to the size of its picture as
+        soon as it is drawn, so the figure holds no full-size image.
+        :param overlays: the images obtained by 'sky_gap_overlays', a list or an iterator.
+        :return: the panel as a BGR image.
+        """
+        # matplotlib is slow to import and only needed for the panels: it is not loaded at all without 'display'.
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
 
-        return fraction_cover, leaf_pix
+        figure = Figure(figsize=(16, 12))
+        canvas = FigureCanvasAgg(figure)
+        figure.subplots_adjust(bottom=0, left=0.01, right=0.99,
+                               top=0.97, wspace=0.01, hspace=0.1)
+        for i, (overlay, t) in enumerate(islice(izip(overlays, self.threshes), 16)):
+            axes = figure.add_subplot(4, 4, i + 1)
+            h, w = overlay.shape[:2]
+            scale = min(1.0, axes.bbox.width / w, axes.bbox.height / h)
+            if scale < 1:
+                overlay = cv2.resize(overlay, (max(1, int(round(w * scale))), max(1, int(round(h * scale)))),
+                                     interpolation=cv2.INTER_AREA)
+            axes.imshow(overlay, 'gray', vmin=0, vmax=255)
+            axes.set_title(t)
+            axes.set_xticks([])
+            axes.set_yticks([])
+        canvas.draw()
+        w, h = canvas.get_width_height()
+        rgba = np.frombuffer(canvas.buffer_rgba(), np.uint8).reshape(h, w, 4)
+
+        return cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGR)
+
+    def save_threshold_panel(self, overlays, file_path):
+        """
+        Saves the threshold panel of an image in 'self.display_dir'.
+        :param overlays: the images obtained by 'sky_gap_overlays'.
+        :param file_path: the path of the analysed image, used to name the panel.
+        :return: the path of the saved panel.
+        """
+        if not os.path.exists(self.display_dir):
+            os.makedirs(self.display_dir)
+        name = os.path.splitext(os.path.basename(file_path))[0]
+        panel_path = os.path.join(self.display_dir, name + '.' + self.display_format)
+        Undistort.write_image(panel_path, self.threshold_panel(overlays))
+
+        return panel_path
+
+    def results_path(self, extension='csv'):
+        """
+        Gets the path of the results file.
+        :param extension: the file extension, 'csv' for the table or 'npz' for the columnar arrays.
+        :return: the file path inside 'self.directory'.
+        """
+        return os.path.join(self.directory, self.results_name + '.' + extension)
+
+    def csv_header(self):
+        """
+        Builds the header of the '.csv' table, which looks like this:
+        'File Name'; 'Leaf pix Count'; 'Porosity'(according to the threshold values).
+        :return: the header as a list.
+        """
+        header = ['File Name', 'Leaf pix Count']
+        for t in self.threshes:
+            if t > 1:
+                header.append('Porosity_Can-EYE_Comparison'.format(t))
+            if t < 1:
+                header.append('Porosity {:.2f}'.format(t))
+        return header
+
+    @staticmethod
+    def csv_row(fraction_cover, file_name, leaf_pix):
+        """
+        Builds a row of the '.csv' table.
+        :param fraction_cover: the fraction cover value.
+        :param file_name: the file name.
+        :param leaf_pix: the number of black pixels contained in the image's 'aoi'.
+        :return: the row as a list.
+        """
+        row = [file_name, leaf_pix]
+        for porosity in ImageAnalysis.porosities(fraction_cover):
+            row.append('{:.4f}'.format(porosity))
+        return row
+
+    @staticmethod
+    def porosities(fraction_cover):
+        """
+        Converts the fraction cover values into porosity values.
+        :param fraction_cover: the fraction cover values, as returned by 'fraction_covers'.
+        :return: a list with the porosity of each value, 0 for an image without crown.
+        """
+        return [0 if float(fc) == 0 else 1-fc for fc in fraction_cover]
 
     def setup_csv(self):
         """
         Defines the setup of the '.csv' file which will contain the results of the analysis. This setup will create the
-        header of the table which looks like this:
-        'File Name'; 'Leaf pix Count'; 'Porosity'(according to the threshold values).
+        header of the table returned by 'csv_header'.
         :return: Nothing.
         """
-        with open(self.directory+'results.csv', 'wb') as f:
-            header = ['File Name', 'Leaf pix Count']
-            for t in self.threshes:
-                if t > 1:
-                    header.append('Porosity_Can-EYE_Comparison'.format(t))
-                if t < 1:
-                    header.append('Porosity {:.2f}'.format(t))
+        with open(self.results_path(), 'wb') as f:
             writer = csv.writer(f, delimiter=';')
-            writer.writerow(header)
+            writer.writerow(self.csv_header())
 
     def save_to_csv(self, fraction_cover, file_name, leaf_pix):
         """
-        Populate the csv table with analysis results
+        Populate the csv table with analysis results. The file is reopened for every row: batches should use
+        'MOSES_Results.ResultsWriter' instead.
         :param fraction_cover: the fraction cover value.
         :param file_name: the file name.
         :param leaf_pix: the number of black pixels contained in the image's 'aoi'.
         :return: Nothing.
         """
-        with open(self.directory+'\\results.csv', 'ab') as f:
+        with open(self.results_path(), 'ab') as f:
             writer = csv.writer(f, delimiter=';')
-            row = [file_name, leaf_pix]
-            for fc in fraction_cover:
-##                print("fc in Cycle")
-##                print(float(fc))
-                if float(fc) == 0:
-##                    print("fc if 0")
-##                    print(fc)
-                    porosity = 0
-                else:
-##                    print("fc")
-##                    print(fc)
-                    porosity = 1-fc
-##                    print("porosity")
-##                    print(porosity)
-                row.append('{:.4f}'.format(porosity))
-            writer.writerow(row)
-
-    def analyse_all(self):
+            writer.writerow(self.csv_row(fraction_cover, file_name, leaf_pix))
+
+    def analyse_all(self, jobs=1, prefetch=2):
         """
         Performs the analysis of all the images contained in the directory defined by the user.
+        :param jobs: the number of processes analysing the images in parallel, 0 to use all the cores. The rows of the
+        '.csv' file keep the order of 'self.file_list'; an image which can't be analysed is reported and skipped.
+        :param prefetch: in the current process, the number of images decoded ahead on background threads while an
+        image is analysed; the rows are then also written on a background thread. 0 does everything in turn.
         :return: Nothing.
         """
-        self.setup_csv()
-        for f in self.file_list:
-            full_path = self.directory+f
-            fraction_cover, leaf_pix = self.analyze_image(full_path)
-##            print("fraction_cover")
-##            print(fraction_cover)
-##            print("leaf_pix")
-##            print(leaf_pix)
-            self.save_to_csv(fraction_cover, f, leaf_pix)
+        full_paths = [self.directory+f for f in self.file_list]
+        background = AsyncWriter() if prefetch > 0 else None
+        try:
+            with ResultsWriter(self, background=background) as results:
+                for i, (full_path, measurement, error) in enumerate(batch_map(self, 'measure_decoded', full_paths,
+                                                                              jobs, read='decode_image',
+                                                                              prefetch=prefetch)):
+                    f = self.file_list[i]
+                    if error is not None:
+                        print 'ERROR: analysis of', f, 'failed:', error
+                        continue
+                    results.write(f, measurement)
+        finally:
+            if background is not None:
+                background.close()
 
 
 def main():
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+
+import hashlib
+import json
+import os
+
+
+class Manifest(object):
+    """
+    Class which records, for each processed image, the state of its file, the calibration and the grid parameters it
+    was processed with, and its pixel counts. It lets a run skip the images whose results are still valid.
+    """
+    def __init__(self, path, **kwargs):
+        """
+        Constructor.
+        :param path: the '.json' file the manifest is loaded from and saved to. None keeps it in memory only.
+        :param kwargs: - 'use_hash': if True a file is identified by the md5 of its content instead of its size and
+                       modification time. Slower, but it survives copies between disks. False by default.
+        """
+        self.path = path
+        self.use_hash = kwargs['use_hash'] if ('use_hash' in kwargs.keys()) else False
+        self.entries = dict()
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as f:
+                self.entries = json.load(f)
+
+    def file_state(self, file_path):
+        """
+        Describes the current state of a file.
+        :param file_path: the file path.
+        :return: a dictionary with either its 'md5' or its 'size' and 'mtime'.
+        """
+        if self.use_hash:
+            digest = hashlib.md5()
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+            return {'md5': digest.hexdigest()}
+        st = os.stat(file_path)
+        return {'size': st.st_size, 'mtime': st.st_mtime}
+
+    def is_current(self, file_path, calibration, parameters):
+        """
+        Checks whether the recorded results of a file are still valid.
+        :param file_path: the file path.
+        :param calibration: the calibration signature, None if the image is not undistorted.
+        :param parameters: the grid parameters, as returned by 'ImageAnalysis.grid_parameters'.
+        :return: True if the file is unchanged and was processed with the same calibration and parameters.
+        """
+        entry = self.entries.get(file_path)
+        if entry is None:
+            return False
+        return (entry['calibration'] == calibration and entry['parameters'] == parameters and
+                entry['file'] == self.file_state(file_path))
+
+    def measurement(self, file_path):
+        """
+        Gets the recorded pixel counts of a file.
+        :param file_path: the file path.
+        :return: the dictionary returned by 'ImageAnalysis.measure_array'.
+        """
+        return self.entries[file_path]['measurement']
+
+    def update(self, file_path, calibration, parameters, measurement):
+        """
+        Records the results of a file.
+        :param file_path: the file path.
+        :param calibration: the calibration signature, None if the image is not undistorted.
+        :param parameters: the grid parameters, as returned by 'ImageAnalysis.grid_parameters'.
+        :param measurement: the dictionary returned by 'ImageAnalysis.measure_array'.
+        :return: Nothing.
+        """
+        self.entries[file_path] = {'file': self.file_state(file_path),
+                                   'calibration': calibration,
+                                   'parameters': parameters,
+                                   'measurement': {'leaf_pix': int(measurement['leaf_pix']),
+                                                   'white': [int(v) for v in measurement['white']],
+                                                   'area': [int(v) for v in measurement['area']],
+                                                   'aoi_area': int(measurement['aoi_area'])}}
+
+    def save(self):
+        """
+        Saves the manifest. The file is replaced only once fully written, so a crash never leaves it truncated.
+        :return: Nothing.
+        """
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            json.dump(self.entries, f)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp_path, self.path)
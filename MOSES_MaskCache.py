@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+#
+
+import os
+import json
+import hashlib
+import numpy as np
+from collections import OrderedDict
+from MOSES_Profiling import telemetry
+
+
+class MaskCache(object):
+    """
+    Class which keeps the binarized images on disk, packed 8 pixels per byte, so that the analysis can be run again
+    with another grid or other thresholds without decoding, undistorting and binarizing the images again. Each mask is
+    a '<key>.npy' file which is memory-mapped when read. Its first row holds the width of the mask, the following ones
+    its packed rows. The files not used for the longest time are removed when the cache grows over its size cap.
+    The directory is listed once: the cache then keeps an index of its files in memory, so a lookup costs a single
+    'os.path.exists' at most. Every entry is a file of its own, so several processes can share the cache; each one
+    counts the entries it has met against the size cap.
+    """
+    def __init__(self, directory, **kwargs):
+        """
+        Constructor.
+        :param directory: the directory of the cache, created if needed.
+        :param kwargs: - 'max_bytes': the size cap of the cache, 1 GB by default.
+        """
+        self.directory = directory
+        self.max_bytes = kwargs['max_bytes'] if ('max_bytes' in kwargs.keys()) else 1 << 30
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        # The size of each entry by key, from the least to the most recently used.
+        self.index = OrderedDict()
+        self.total_bytes = 0
+        entries = []
+        for f in os.listdir(directory):
+            if f.endswith('.npy'):
+                try:
+                    st = os.stat(os.path.join(directory, f))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, f[:-len('.npy')], st.st_size))
+        for mtime, key, size in sorted(entries):
+            self.add_entry(key, size)
+
+    @staticmethod
+    def key(file_path, calibration=None, reduction=1):
+        """
+        Builds the key of the mask of an image. It changes when the file does, or when it is undistorted or decoded
+        otherwise.
+        :param file_path: the image file path.
+        :param calibration: the calibration signature, None if the image is not undistorted.
+        :param reduction: the factor the image is reduced by when decoded.
+        :return: the key, as an hexadecimal string.
+        """
+        st = os.stat(file_path)
+        source = {'path': os.path.abspath(file_path), 'size': st.st_size, 'mtime': st.st_mtime,
+                  'calibration': calibration, 'reduction': reduction}
+        return hashlib.md5(json.dumps(source, sort_keys=True)).hexdigest()
+
+    def path(self, key):
+        """
+        Gets the file of a mask.
+        :param key: the key returned by 'key'.
+        :return: the file path.
+        """
+        return os.path.join(self.directory, key + '.npy')
+
+    def add_entry(self, key, size):
+        """
+        Records an entry in the index as the most recently used one.
+        :param key: the key of the entry.
+        :param size: the size of its file.
+        :return: Nothing.
+        """
+        self.drop_entry(key)
+        self.index[key] = size
+        self.total_bytes += size
+
+    def drop_entry(self, key):
+        """
+        Removes an entry from the index, not its file.
+        :param key: the key of the entry.
+        :return: Nothing.
+        """
+        size = self.index.pop(key, None)
+        if size is not None:
+            self.total_bytes -= size
+
+    def entries(self):
+        """
+        Lists the masks of the cache known to the index.
+        :return: a dictionary of the file paths by key.
+        """
+        return dict((key, self.path(key)) for key in self.index)
+
+    def get(self, key):
+        """
+        Reads a mask from the cache, marking it as the last one used.
+        :param key: the key returned by 'key'.
+        :return: the binarized image (0 and 255), None if it is not in the cache.
+        """
+        path = self.path(key)
+        if key not in self.index and not os.path.exists(path):
+            return None
+        try:
+            with telemetry.stage('mask_cache_read') as stage:
+                stored = np.load(path, mmap_mode='r')
+                width = int(np.frombuffer(stored[0, :8].tobytes(), '<u8')[0])
+                mask = np.unpackbits(stored[1:], axis=1)[:, :width]
+                mask *= 255
+                stage.add(bytes_read=stored.nbytes, pixels=mask.size)
+            size = os.path.getsize(path)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError, IndexError):
+            # Removed by another process, or partly written.
+            self.drop_entry(key)
+            return None
+        self.add_entry(key, size)
+        return np.ascontiguousarray(mask)
+
+    def put(self, key, mask):
+        """
+        Stores a mask, then removes the masks used least recently while the cache is over its size cap.
+        :param key: the key returned by 'key'.
+        :param mask: the binarized image: the non-zero pixels are white.
+        :return: Nothing.
+        """
+        h, w = mask.shape[:2]
+        path = self.path(key)
+        tmp_path = path + '.tmp'
+        with telemetry.stage('mask_cache_write', pixels=h * w) as stage:
+            packed = np.packbits(mask != 0, axis=1)
+            # The first row holds the width, which the packed rows round up to a multiple of 8.
+            stored = np.zeros((h + 1, max(8, packed.shape[1])), np.uint8)
+            stored[0, :8] = np.frombuffer(np.array([w], '<u8').tobytes(), np.uint8)
+            stored[1:, :packed.shape[1]] = packed
+            with open(tmp_path, 'wb') as f:
+                np.save(f, stored)
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp_path, path)
+            size = os.path.getsize(path)
+            stage.add(bytes_written=size)
+        self.add_entry(key, size)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """
+        Removes the masks used least recently until the cache is within its size cap.
+        :param keep: the key of an entry which is never removed, such as the one just written.
+        :return: Nothing.
+        """
+        for key in list(self.index.keys()):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                # Already removed by another process, or still in use.
+                pass
+            self.drop_entry(key)
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+#
+
+import cv2
+import Queue
+import threading
+import multiprocessing
+import traceback
+from collections import deque
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+from MOSES_Profiling import telemetry
+
+# The object whose method is called by the worker processes, set once per process by 'init_worker'.
+_worker = None
+
+
+def init_worker(worker, telemetry_state):
+    """
+    Initializes a worker process of the pool.
+    :param worker: the object whose method will be called on each item.
+    :param telemetry_state: the telemetry settings of the main process, see 'Telemetry.state'.
+    :return: Nothing.
+    """
+    global _worker
+    _worker = worker
+    enabled, path = telemetry_state
+    if enabled:
+        telemetry.configure(path, truncate=False)
+    # Every process already works on its own image: OpenCV threads would only compete with the other workers.
+    cv2.setNumThreads(1)
+
+
+def call_function(function, *args):
+    """
+    Calls a function, trapping any error so that one bad image can't stop the batch.
+    :param function: the function.
+    :param args: its arguments.
+    :return: a tuple (result, error): the error is the formatted traceback, None if the call succeeded.
+    """
+    try:
+        return function(*args), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def call_worker(args):
+    """
+    Calls the worker method on a single item, see 'call_function'.
+    :param args: a tuple (method name, read method name or None, item), see 'batch_map'.
+    :return: a tuple (result, error).
+    """
+    method, read, item = args
+    if read is None:
+        return call_function(getattr(_worker, method), item)
+    data, error = call_function(getattr(_worker, read), item)
+    if error is not None:
+        return None, error
+    return call_function(getattr(_worker, method), data, item)
+
+
+def prefetch_map(function, items, depth=2):
+    """
+    Calls a function on every item on background threads, keeping 'depth' items ahead of the caller. It is meant for
+    decoding files: OpenCV releases the interpreter while it reads and decodes, so the next images are loaded while the
+    current one is processed. At most 'depth' + 1 results are held at once.
+    :param function: the function, called with an item.
+    :param items: the list of items.
+    :param depth: the number of items read ahead, 0 to call the function in the caller's thread.
+    :return: a generator of tuples (item, result, error), in the order of 'items', see 'call_function'.
+    """
+    if depth <= 0:
+        for item in items:
+            result, error = call_function(function, item)
+            yield item, result, error
+        return
+
+    pool = ThreadPool(depth)
+    try:
+        remaining = iter(items)
+        pending = deque((item, pool.apply_async(call_function, (function, item))) for item in islice(remaining, depth))
+        while pending:
+            item, task = pending.popleft()
+            for following in islice(remaining, 1):
+                pending.append((following, pool.apply_async(call_function, (function, following))))
+            result, error = task.get()
+            yield item, result, error
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def batch_map(worker, method, items, jobs=1, **kwargs):
+    """
+    Calls 'worker.method' on every item, using a pool of 'jobs' processes. The results come back in the same order as
+    'items', whatever the number of processes.
+    :param worker: the object whose method is called. It is sent once to every process, so it must be picklable.
+    :param method: the name of the method to call.
+    :param items: the list of items.
+    :param jobs: the number of processes. 1 runs everything in the current process, 0 or None uses all the cores.
+    :param kwargs: - 'read': the name of a method which loads the data of an item, such as the decoded image. If
+                   given, 'worker.method' is called as 'worker.method(data, item)'. In the current process the items
+                   are then read ahead on background threads, see 'prefetch_map'. None by default;
+                   - 'prefetch': the number of items read ahead, 2 by default.
+    :return: a generator of tuples (item, result, error): error is the formatted traceback of a failed call, None
+    otherwise.
+    """
+    read = kwargs['read'] if ('read' in kwargs.keys()) else None
+    prefetch = kwargs['prefetch'] if ('prefetch' in kwargs.keys()) else 2
+    if jobs is None or jobs <= 0:
+        jobs = multiprocessing.cpu_count()
+    if jobs == 1 or len(items) <= 1:
+        if read is None:
+            reads = ((item, item, None) for item in items)
+        else:
+            reads = prefetch_map(getattr(worker, read), items, prefetch)
+        for item, data, error in reads:
+            result = None
+            if error is None:
+                arguments = (data,) if read is None else (data, item)
+                result, error = call_function(getattr(worker, method), *arguments)
+            yield item, result, error
+        return
+
+    pool = multiprocessing.Pool(min(jobs, len(items)), init_worker, (worker, telemetry.state()))
+    try:
+        for i, (result, error) in enumerate(pool.imap(call_worker, [(method, read, item) for item in items])):
+            yield items[i], result, error
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class WorkerPool(object):
+    """
+    Class which calls a worker method on items submitted one at a time, for a stream of items whose end is not known
+    in advance. The results are collected in the same order as the items were submitted.
+    """
+    def __init__(self, worker, jobs=1):
+        """
+        Constructor.
+        :param worker: the object whose method is called. It is sent once to every process, so it must be picklable.
+        :param jobs: the number of processes. 1 runs everything in the current process, 0 or None uses all the cores.
+        """
+        if jobs is None or jobs <= 0:
+            jobs = multiprocessing.cpu_count()
+        self.worker = worker
+        self.jobs = jobs
+        self.pool = None
+        if jobs > 1:
+            self.pool = multiprocessing.Pool(jobs, init_worker, (worker, telemetry.state()))
+        # The submitted items with their pending result, in submission order.
+        self.tasks = []
+
+    def submit(self, method, item):
+        """
+        Submits an item. Without worker processes it is processed straight away.
+        :param method: the name of the method to call.
+        :param item: the item.
+        :return: Nothing.
+        """
+        if self.pool is not None:
+            self.tasks.append((item, self.pool.apply_async(call_worker, ((method, None, item),))))
+            return
+        self.tasks.append((item, call_function(getattr(self.worker, method), item)))
+
+    def pending(self):
+        """
+        Gets the number of submitted items whose results were not collected yet.
+        :return: the number of items.
+        """
+        return len(self.tasks)
+
+    def completed(self):
+        """
+        Collects the results available so far. A result is only collected once those of the items submitted before
+        it are, to keep the order.
+        :return: a list of tuples (item, result, error), as yielded by 'batch_map'.
+        """
+        done = []
+        while self.tasks:
+            item, task = self.tasks[0]
+            if self.pool is not None:
+                if not task.ready():
+                    break
+                task = task.get()
+            self.tasks.pop(0)
+            done.append((item, task[0], task[1]))
+        return done
+
+    def close(self):
+        """
+        Stops the worker processes, dropping the items still pending.
+        :return: Nothing.
+        """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.tasks = []
+
+
+class AsyncWriter(object):
+    """
+    Class which runs the writes of a batch, such as the undistorted images and the rows of the results, on a
+    background thread, so that the processing goes on while the disk is busy. The writes are run in the order they
+    were submitted. The queue is bounded: when the disk can't keep up, 'submit' waits, which caps the memory held by
+    the pending writes.
+    """
+    def __init__(self, max_pending=4):
+        """
+        Constructor. The thread is started straight away.
+        :param max_pending: the number of writes which can wait in the queue.
+        """
+        self.tasks = Queue.Queue(max_pending)
+        self.failures = 0
+        self.thread = threading.Thread(target=self.work)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def work(self):
+        """
+        Runs the writes, until 'close' is called. A failed write is reported and the following ones go on.
+        :return: Nothing.
+        """
+        while True:
+            task = self.tasks.get()
+            try:
+                if task is None:
+                    return
+                function, args = task
+                result, error = call_function(function, *args)
+                if error is not None:
+                    self.failures += 1
+                    print 'ERROR: background write failed:', error
+            finally:
+                self.tasks.task_done()
+
+    def submit(self, function, *args):
+        """
+        Queues a write, waiting if the queue is full.
+        :param function: the function which writes.
+        :param args: its arguments. They must not be modified afterwards.
+        :return: Nothing.
+        """
+        self.tasks.put((function, args))
+
+    def drain(self):
+        """
+        Waits for all the queued writes to be done.
+        :return: Nothing.
+        """
+        self.tasks.join()
+
+    def close(self):
+        """
+        Runs the queued writes and stops the thread.
+        :return: Nothing.
+        """
+        if self.thread.is_alive():
+            self.tasks.put(None)
+            self.thread.join()
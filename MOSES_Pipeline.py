@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+#
+
+import os
+import cv2
+import copy
+import time
+import numpy as np
+from collections import deque
+from MOSES_Manifest import Manifest
+from MOSES_Parallel import batch_map, WorkerPool, AsyncWriter
+from MOSES_Profiling import telemetry
+from MOSES_Results import ResultsWriter
+from MOSES_UndistortImage import Undistort, ROWS_BYTES_PER_PIXEL
+
+
+class Pipeline(object):
+    """
+    Class which contains functions definition to undistort and analyse a set of images in a single pass. Each image is
+    decoded once, undistorted and converted to grayscale in memory, then handed straight to the analysis.
+    """
+    def __init__(self, undistort, image_analysis, **kwargs):
+        """
+        Constructor.
+        :param undistort: the 'Undistort' object holding the images and the calibration. None analyses the images as
+        they are.
+        :param image_analysis: the 'ImageAnalysis' object which computes and saves the results.
+        :param kwargs: - 'file_list': the images to process, as dictionaries with keys 'name' and 'path'.
+                       'undistort.file_list', or all the images of the survey with 'calibrations', by default;
+                       - 'calibrations': a 'CalibrationRegistry' which routes each image to the calibration of its
+                       camera, used instead of 'undistort'. None by default;
+                       - 'save_undistorted': if True the undistorted images are also written to
+                       'undistort.save_path', as 'Undistort.undistort_all' does. False by default;
+                       - 'resume': if True a manifest is kept next to the results, and the images whose results are
+                       still valid are not processed again. False by default;
+                       - 'checkpoint': number of processed images after which the manifest and the results are saved,
+                       50 by default;
+                       - 'columnar': if True the raw results are also saved as arrays in 'results.npz'. False by
+                       default;
+                       - 'sweep': the porosity curve saved in 'results.npz' for each image, see 'ResultsWriter';
+                       - 'reduction': 1, 2, 4 or 8: the images are decoded with their width and height divided by it,
+                       for a fast preview of the results, see 'preview_report'. 1 by default;
+                       - 'prefetch': the number of images decoded ahead on background threads while an image is
+                       processed, when 'run' works in the current process. 2 by default, 0 to decode them in turn.
+                       The undistorted images and the rows of the results are then also written on a background
+                       thread.
+        """
+        self.undistort = undistort
+        self.image_analysis = image_analysis
+        self.calibrations = kwargs['calibrations'] if ('calibrations' in kwargs.keys()) else None
+        if 'file_list' in kwargs.keys():
+            self.file_list = kwargs['file_list']
+        elif self.calibrations is not None:
+            self.file_list = self.calibrations.image_list()
+        else:
+            self.file_list = undistort.file_list
+        self.save_undistorted = kwargs['save_undistorted'] if ('save_undistorted' in kwargs.keys()) else False
+        self.resume = kwargs['resume'] if ('resume' in kwargs.keys()) else False
+        self.checkpoint = kwargs['checkpoint'] if ('checkpoint' in kwargs.keys()) else 50
+        self.columnar = kwargs['columnar'] if ('columnar' in kwargs.keys()) else False
+        self.sweep = kwargs['sweep'] if ('sweep' in kwargs.keys()) else None
+        self.reduction = kwargs['reduction'] if ('reduction' in kwargs.keys()) else 1
+        self.prefetch = kwargs['prefetch'] if ('prefetch' in kwargs.keys()) else 2
+        # The 'AsyncWriter' of the undistorted images while 'run' works in the current process.
+        self.background = None
+
+    def __getstate__(self):
+        # The writer thread stays in the main process: the worker processes write the images themselves.
+        state = self.__dict__.copy()
+        state['background'] = None
+        return state
+
+    def undistort_for(self, image):
+        """
+        Gets the 'Undistort' object of an image: the one of its camera with 'self.calibrations', 'self.undistort'
+        otherwise.
+        :param image: a dictionary of 'self.file_list', with keys 'name' and 'path'.
+        :return: the 'Undistort' object, None if the images are not undistorted.
+        """
+        if self.calibrations is not None:
+            return self.calibrations.route(image)
+        return self.undistort
+
+    def calibration_signature(self, image):
+        """
+        Gets the signature of the calibration an image is undistorted with, see 'Undistort.calibration_signature'.
+        :param image: a dictionary of 'self.file_list', with keys 'name' and 'path'.
+        :return: the signature, None if the images are not undistorted.
+        """
+        undistort = self.undistort_for(image)
+        return undistort.calibration_signature() if undistort is not None else None
+
+    def mask_key(self, image):
+        """
+        Gets the key of the binarized image of an image in the 'mask_cache' of the analysis.
+        :param image: a dictionary of 'self.file_list', with keys 'name' and 'path'.
+        :return: the key, None without cache or if the undistorted images are saved, which needs them decoded.
+        """
+        if self.save_undistorted:
+            return None
+        return self.image_analysis.mask_key(image['path'], self.calibration_signature(image), self.reduction)
+
+    def decode_image(self, image):
+        """
+        Decodes an image, in color if it is undistorted, unless its binarized image is in the 'mask_cache' of the
+        analysis.
+        :param image: a dictionary of 'self.file_list', with keys 'name' and 'path'.
+        :return: a tuple (image, mask): either the decoded image and None, or None and the binarized image.
+        """
+        mask = self.image_analysis.cached_mask(self.mask_key(image))
+        if mask is not None:
+            return None, mask
+        color = self.undistort_for(image) is not None
+        return Undistort.read_image(image['path'], cv2.IMREAD_COLOR if color else cv2.IMREAD_GRAYSCALE,
+                                    self.reduction), None
+
+    def process_image(self, image):
+        """
+        Undistorts an image and performs its pixel counts.
+        :param image: a dictionary of 'self.file_list', with keys 'name' and 'path'.
+        :return: the same results as 'ImageAnalysis.measure_array'.
+        """
+        return self.analyse_decoded(self.decode_image(image), image)
+
+    def analyse_decoded(self, decoded, image):
+        """
+        Undistorts an image already decoded by 'decode_image' and performs its pixel counts.
+        :param decoded: the tuple (image, mask) returned by 'decode_image'.
+        :param image: a dictionary of 'self.file_list', with keys 'name' and 'path'.
+        :return: the same results as 'ImageAnalysis.measure_array'.
+        """
+        print 'Analysing: ', image['path']
+        img, mask = decoded
+        undistort = self.undistort_for(image)
+        # The 'image' stage covers the processing, the other stages are recorded inside it. The decoding is recorded
+        # on its own, as it may run ahead on another thread.
+        with telemetry.stage('image') as stage:
+            if mask is not None:
+                stage.add(pixels=mask.shape[0] * mask.shape[1])
+                return self.image_analysis.measure_binarized(mask, image['path'])
+            if undistort is None:
+                pass
+            elif self.image_analysis.memory_budget is not None and not self.save_undistorted:
+                # Neither the undistorted image nor its maps are held whole: each band of rows is undistorted, with
+                # maps of its own, when it is analysed.
+                shape = undistort.undistorted_shape(img, self.reduction)
+                stage.add(pixels=shape[0] * shape[1])
+
+                def read_rows(first, last):
+                    return undistort.undistort_gray_rows(img, first, last, self.reduction)
+                return self.image_analysis.measure_bands(read_rows, shape, image['path'], ROWS_BYTES_PER_PIXEL)
+            else:
+                save_name = image['name'] if self.save_undistorted else None
+                img = undistort.undistort_decoded(img, save_name, self.reduction, self.background)
+            stage.add(pixels=img.shape[0] * img.shape[1])
+
+            return self.image_analysis.measure_array(img, image['path'], self.mask_key(image))
+
+    def manifest_path(self):
+        """
+        Gets the path of the manifest, which is kept next to the '.csv' file of the analysis. Each results name, such
+        as the one of a preview, has its own manifest: 'manifest.json' for 'results', '<results_name>_manifest.json'
+        otherwise.
+        :return: the manifest path, None if 'self.resume' is False.
+        """
+        if not self.resume:
+            return None
+        results_name = self.image_analysis.results_name
+        name = 'manifest.json' if results_name == 'results' else results_name + '_manifest.json'
+        return os.path.join(self.image_analysis.directory, name)
+
+    def parameters(self):
+        """
+        Gets the parameters the results of an image depend on, recorded in the manifest.
+        :return: the grid parameters of 'ImageAnalysis.grid_parameters', with the 'reduction' of a preview.
+        """
+        parameters = self.image_analysis.grid_parameters()
+        if self.reduction != 1:
+            parameters['reduction'] = self.reduction
+        return parameters
+
+    def run(self, jobs=1):
+        """
+        Performs the undistortion and the analysis of all the images of 'self.file_list', saving the results to the
+        '.csv' file of the analysis. With 'self.resume' only the new or changed images are processed, and the rows of
+        the others are rebuilt from the manifest.
+        :param jobs: the number of processes working on the images in parallel, 0 to use all the cores. The rows of
+        the '.csv' file keep the order of 'self.file_list'; an image which can't be processed is reported and skipped.
+        :return: Nothing.
+        """
+        manifest = Manifest(self.manifest_path())
+        # Every image is routed to its camera here, before the worker processes get a copy of the registry.
+        calibrations = [self.calibration_signature(image) for image in self.file_list]
+        parameters = self.parameters()
+        current = [manifest.is_current(image['path'], calibration, parameters)
+                   for image, calibration in zip(self.file_list, calibrations)]
+        stale = [image for image, is_current in zip(self.file_list, current) if not is_current]
+        print 'Images to process:', len(stale), 'of', len(self.file_list)
+        background = AsyncWriter() if self.prefetch > 0 else None
+        self.background = background
+        try:
+            self.write_results(batch_map(self, 'analyse_decoded', stale, jobs, read='decode_image',
+                                         prefetch=self.prefetch),
+                               manifest, current, calibrations, parameters, background)
+        finally:
+            self.background = None
+            if background is not None:
+                background.close()
+        manifest.save()
+
+    def write_results(self, results, manifest, current, calibrations, parameters, background):
+        """
+        Writes the rows of 'run', in the order of 'self.file_list'.
+        :param results: the generator of the results of the images to process, see 'batch_map'.
+        :param manifest: the manifest, updated with the processed images.
+        :param current: for each image, whether its results in the manifest are still valid.
+        :param calibrations: for each image, its calibration signature, see 'calibration_signature'.
+        :param parameters: the parameters returned by 'parameters'.
+        :param background: the 'AsyncWriter' of the rows, None to write them straight away.
+        :return: Nothing.
+        """
+        processed = 0
+        with ResultsWriter(self.image_analysis, checkpoint=self.checkpoint, columnar=self.columnar,
+                           sweep=self.sweep, background=background) as writer:
+            for image, is_current, calibration in zip(self.file_list, current, calibrations):
+                if not is_current:
+                    # The stale images come out of the batch in the same order as 'self.file_list'.
+                    image, measurement, error = next(results)
+                    if error is not None:
+                        print 'ERROR: processing of', image['name'], 'failed:', error
+                        continue
+                    manifest.update(image['path'], calibration, parameters, measurement)
+                    processed += 1
+                    if processed % self.checkpoint == 0:
+                        writer.flush()
+                        manifest.save()
+                else:
+                    measurement = manifest.measurement(image['path'])
+                writer.write(image['name'], measurement)
+
+    def watch(self, watcher, jobs=1, **kwargs):
+        """
+        Processes the images of a directory as they are written to it, until interrupted with Ctrl+C. Each row is
+        written to the '.csv' file as soon as its image is analysed. The images which were already there are processed
+        first; with 'self.resume' those whose results are still valid are not processed again.
+        :param watcher: the 'FolderWatcher' which reports the new images.
+        :param jobs: the number of processes working on the images in parallel, 0 to use all the cores.
+        :param kwargs: - 'interval': the seconds between two polls of the directory, 1 by default;
+                       - 'max_pending': the number of images being processed at once, twice the number of processes
+                       by default. When the capture is faster than the analysis the other images wait on disk, and
+                       only their names are kept;
+                       - 'idle_timeout': if given, the watch stops after this many seconds without new images and with
+                       nothing left to process. None by default.
+        :return: Nothing.
+        """
+        interval = kwargs['interval'] if ('interval' in kwargs.keys()) else 1.0
+        idle_timeout = kwargs['idle_timeout'] if ('idle_timeout' in kwargs.keys()) else None
+        pool = WorkerPool(self, jobs)
+        max_pending = kwargs['max_pending'] if ('max_pending' in kwargs.keys()) else 2 * pool.jobs
+        manifest = Manifest(self.manifest_path())
+        parameters = self.parameters()
+        backlog = deque()
+        processed = 0
+        waiting = 0
+        last_activity = time.time()
+        print 'Watching:', watcher.directory
+        # The table is flushed after every row, so that it can be read while the watch goes on.
+        writer = ResultsWriter(self.image_analysis, checkpoint=1, columnar=self.columnar, sweep=self.sweep)
+        writer.open()
+        try:
+            while True:
+                progressed = False
+                for image in watcher.poll():
+                    last_activity = time.time()
+                    if manifest.is_current(image['path'], self.calibration_signature(image), parameters):
+                        writer.write(image['name'], manifest.measurement(image['path']))
+                    else:
+                        backlog.append(image)
+                while backlog and pool.pending() < max_pending:
+                    pool.submit('process_image', backlog.popleft())
+                    progressed = True
+                for image, measurement, error in pool.completed():
+                    last_activity = time.time()
+                    progressed = True
+                    if error is not None:
+                        print 'ERROR: processing of', image['name'], 'failed:', error
+                        continue
+                    manifest.update(image['path'], self.calibration_signature(image), parameters, measurement)
+                    writer.write(image['name'], measurement)
+                    processed += 1
+                    if processed % self.checkpoint == 0:
+                        manifest.save()
+                if len(backlog) != waiting:
+                    waiting = len(backlog)
+                    if waiting:
+                        print 'Capture ahead of analysis:', waiting, 'images waiting'
+                if (idle_timeout is not None and not backlog and pool.pending() == 0 and
+                        time.time() - last_activity >= idle_timeout):
+                    break
+                if not progressed:
+                    # Results are checked more often than the directory while images are being processed.
+                    time.sleep(interval if pool.pending() == 0 else min(interval, 0.05))
+        except KeyboardInterrupt:
+            print 'Watch interrupted'
+        finally:
+            pool.close()
+            writer.close()
+            manifest.save()
+        print 'Images processed:', processed
+
+    def image_porosity(self, image):
+        """
+        Processes an image and computes its porosity values.
+        :param image: a dictionary of 'self.file_list', with keys 'name' and 'path'.
+        :return: an array with the porosity of each threshold, as in the '.csv' table.
+        """
+        measurement = self.process_image(image)
+        fraction_cover = self.image_analysis.fraction_cover_from_cells(measurement)
+        return np.array(self.image_analysis.porosities(fraction_cover), dtype=np.float64)
+
+    def preview_report(self, sample=10):
+        """
+        Measures the error of the preview against the full resolution on a sample of the images: each one is processed
+        both ways and their porosity values are compared.
+        :param sample: the number of images, evenly spread over 'self.file_list'.
+        :return: a dictionary with keys 'images' (the number of images compared), 'labels' (the threshold columns),
+        'mean_abs_error' and 'max_abs_error' (one value per threshold column), 'seconds_full' and 'seconds_preview'
+        (the processing times).
+        """
+        images = self.file_list[::max(1, len(self.file_list) // max(1, sample))][:sample]
+        full = copy.copy(self)
+        full.reduction = 1
+        labels = self.image_analysis.csv_header()[2:]
+        errors = []
+        seconds_full = seconds_preview = 0.0
+        for image in images:
+            start = time.time()
+            porosity = full.image_porosity(image)
+            seconds_full += time.time() - start
+            start = time.time()
+            errors.append(np.abs(self.image_porosity(image) - porosity))
+            seconds_preview += time.time() - start
+        errors = np.array(errors, dtype=np.float64) if images else np.zeros((0, len(labels)))
+
+        return {'images': len(images), 'labels': labels,
+                'mean_abs_error': errors.mean(axis=0) if len(images) else errors.sum(axis=0),
+                'max_abs_error': errors.max(axis=0) if len(images) else errors.sum(axis=0),
+                'seconds_full': seconds_full, 'seconds_preview': seconds_preview}
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+#
+
+import json
+import os
+import time
+
+
+class Stage(object):
+    """
+    Class which times a stage of the processing of an image, used as a 'with' block. Counters can be added while the
+    stage runs, for example the number of pixels once the image is decoded.
+    """
+    def __init__(self, telemetry, name, counters):
+        """
+        Constructor.
+        :param telemetry: the 'Telemetry' object the stage is recorded to.
+        :param name: the stage name, such as 'decode' or 'binarize'.
+        :param counters: the initial counters: 'bytes_read', 'bytes_written', 'pixels'.
+        """
+        self.telemetry = telemetry
+        self.name = name
+        self.counters = counters
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.telemetry.record(self.name, time.time() - self.start, **self.counters)
+
+    def add(self, **counters):
+        """
+        Adds to the counters of the stage.
+        :param counters: the amounts to add, by counter name.
+        :return: Nothing.
+        """
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+
+class NoStage(object):
+    """
+    Class which stands for 'Stage' when the telemetry is disabled, so that the instrumented code costs nothing.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+    def add(self, **counters):
+        pass
+
+
+class Telemetry(object):
+    """
+    Class which collects the wall time, bytes read and written and pixels processed by each stage of the processing.
+    The records can be streamed as JSON lines to a file shared by all the worker processes, and summed up in a report.
+    """
+    def __init__(self):
+        """
+        Constructor. The telemetry is disabled until 'configure' is called.
+        """
+        self.enabled = False
+        self.path = None
+        self.stream = None
+        self.totals = dict()
+
+    def __getstate__(self):
+        # The open stream can't be sent to a worker process: it is reopened there.
+        state = self.__dict__.copy()
+        state['stream'] = None
+        return state
+
+    def configure(self, path=None, truncate=True):
+        """
+        Enables the telemetry.
+        :param path: the JSON lines file the records are appended to. None keeps them in memory only, in which case the
+        stages run by worker processes are not collected.
+        :param truncate: if True the file is emptied first. The worker processes append to the file of the main one.
+        :return: Nothing.
+        """
+        self.enabled = True
+        self.path = path
+        self.totals = dict()
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        if path is not None and truncate:
+            open(path, 'w').close()
+
+    def state(self):
+        """
+        Gets what a worker process needs to record to the same place, see 'configure'.
+        :return: a tuple (enabled, path).
+        """
+        return self.enabled, self.path
+
+    def stage(self, name, **counters):
+        """
+        Times a stage, used as 'with telemetry.stage('decode', bytes_read=size) as stage:'.
+        :param name: the stage name.
+        :param counters: the initial counters: 'bytes_read', 'bytes_written', 'pixels'.
+        :return: the 'Stage' object, or a 'NoStage' if the telemetry is disabled.
+        """
+        if not self.enabled:
+            return NoStage()
+        return Stage(self, name, counters)
+
+    def record(self, name, seconds, **counters):
+        """
+        Records a stage run.
+        :param name: the stage name.
+        :param seconds: the wall time of the run.
+        :param counters: 'bytes_read', 'bytes_written', 'pixels'.
+        :return: Nothing.
+        """
+        if not self.enabled:
+            return
+        entry = {'stage': name, 'seconds': seconds, 'pid': os.getpid(), 'time': time.time(),
+                 'bytes_read': counters.get('bytes_read', 0),
+                 'bytes_written': counters.get('bytes_written', 0),
+                 'pixels': counters.get('pixels', 0)}
+        self.add_to_totals(self.totals, entry)
+        if self.path is not None:
+            if self.stream is None:
+                self.stream = open(self.path, 'a')
+            self.stream.write(json.dumps(entry, sort_keys=True) + '\n')
+            self.stream.flush()
+
+    @staticmethod
+    def add_to_totals(totals, entry):
+        """
+        Adds a record to the totals of its stage.
+        :param totals: the dictionary of the totals, by stage name.
+        :param entry: the record.
+        :return: Nothing.
+        """
+        total = totals.setdefault(entry['stage'], {'count': 0, 'seconds': 0.0, 'bytes_read': 0,
+                                                   'bytes_written': 0, 'pixels': 0})
+        total['count'] += 1
+        for key in ('seconds', 'bytes_read', 'bytes_written', 'pixels'):
+            total[key] += entry[key]
+
+    def summary(self):
+        """
+        Sums up the records by stage. With a file, the records of all the processes are read back from it.
+        :return: a dictionary of totals by stage name, each with 'count', 'seconds', 'bytes_read', 'bytes_written'
+        and 'pixels'.
+        """
+        if self.path is None or not os.path.exists(self.path):
+            return self.totals
+        if self.stream is not None:
+            self.stream.flush()
+        totals = dict()
+        with open(self.path) as f:
+            for line in f:
+                if line.strip():
+                    self.add_to_totals(totals, json.loads(line))
+        return totals
+
+    def report(self):
+        """
+        Formats the summary as a table, with the share of the processing time of each stage.
+        :return: the table as a string.
+        """
+        totals = self.summary()
+        # The 'image' stage contains the others: when present, the shares are relative to it.
+        if 'image' in totals:
+            overall = totals['image']['seconds'] or 1.0
+        else:
+            overall = sum(total['seconds'] for total in totals.values()) or 1.0
+        lines = ['{:<14}{:>8}{:>11}{:>8}{:>11}{:>11}{:>10}{:>10}'.format('stage', 'count', 'seconds', '%', 'MB read',
+                                                                   'MB written', 'MPix', 'MPix/s')]
+        for name, total in sorted(totals.items(), key=lambda item: -item[1]['seconds']):
+            mpix = total['pixels'] / 1e6
+            lines.append('{:<14}{:>8}{:>11.3f}{:>8.1f}{:>11.1f}{:>11.1f}{:>10.1f}{:>10.1f}'.format(
+                name, total['count'], total['seconds'], 100.0 * total['seconds'] / overall,
+                total['bytes_read'] / 1e6, total['bytes_written'] / 1e6, mpix,
+                mpix / total['seconds'] if total['seconds'] > 0 else 0))
+        return '\n'.join(lines)
+
+
+# The telemetry shared by all the modules of the process.
+telemetry = Telemetry()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+#
+
+import csv
+import numpy as np
+from MOSES_Profiling import telemetry
+from MOSES_GeoIndex import parse_image_names
+
+
+class ResultsWriter(object):
+    """
+    Class which saves the results of a batch. The '.csv' table is opened once for the whole batch and flushed every
+    'checkpoint' rows; optionally the raw numbers are also saved as numeric arrays in a '.npz' file, which loads much
+    faster than the formatted table.
+    """
+    def __init__(self, image_analysis, **kwargs):
+        """
+        Constructor.
+        :param image_analysis: the 'ImageAnalysis' object whose thresholds, header and directory are used.
+        :param kwargs: - 'checkpoint': number of rows after which the table is flushed to disk, 50 by default;
+                       - 'columnar': if True 'results.npz' is written next to 'results.csv' when the writer is
+                       closed. False by default;
+                       - 'sweep': if given, the porosity curve of each image is also saved in 'results.npz'. Either the
+                       number of thresholds evenly spaced between 0 and 1, or the list of thresholds. None by default;
+                       - 'background': an 'AsyncWriter' the rows are written by, so that the batch doesn't wait for the
+                       disk. None (rows written straight away) by default.
+        """
+        self.image_analysis = image_analysis
+        self.checkpoint = kwargs['checkpoint'] if ('checkpoint' in kwargs.keys()) else 50
+        self.columnar = kwargs['columnar'] if ('columnar' in kwargs.keys()) else False
+        self.sweep = kwargs['sweep'] if ('sweep' in kwargs.keys()) else None
+        if self.sweep is not None:
+            # The curves are only saved in the '.npz' file.
+            self.columnar = True
+            if np.isscalar(self.sweep):
+                self.sweep = np.linspace(0, 1, self.sweep)
+            self.sweep = np.asarray(self.sweep, dtype=np.float64)
+        self.background = kwargs['background'] if ('background' in kwargs.keys()) else None
+        self.csv_file = None
+        self.writer = None
+        self.rows = 0
+        self.columns = {'file_name': [], 'leaf_pix': [], 'crown_pix': [], 'fraction_cover': [],
+                        'cell_white_ratio': [], 'porosity_curve': []}
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def open(self):
+        """
+        Creates the '.csv' table and writes its header.
+        :return: Nothing.
+        """
+        self.csv_file = open(self.image_analysis.results_path(), 'wb')
+        self.writer = csv.writer(self.csv_file, delimiter=';')
+        self.writer.writerow(self.image_analysis.csv_header())
+
+    def write(self, file_name, measurement):
+        """
+        Adds the results of an image.
+        :param file_name: the file name.
+        :param measurement: the dictionary returned by 'ImageAnalysis.measure_array'.
+        :return: Nothing.
+        """
+        crown_pixels, large_gap = self.image_analysis.crown_counts_from_cells(measurement['white'],
+                                                                              measurement['area'],
+                                                                              measurement['aoi_area'])
+        fraction_cover = self.image_analysis.fraction_covers(measurement['leaf_pix'], crown_pixels)
+        row = self.image_analysis.csv_row(fraction_cover, file_name, measurement['leaf_pix'])
+        if self.background is not None:
+            self.background.submit(self.write_row, row)
+        else:
+            self.write_row(row)
+
+        if self.columnar:
+            self.columns['file_name'].append(file_name)
+            self.columns['leaf_pix'].append(measurement['leaf_pix'])
+            self.columns['crown_pix'].append(crown_pixels)
+            self.columns['fraction_cover'].append([float(fc) for fc in fraction_cover])
+            self.columns['cell_white_ratio'].append(np.asarray(measurement['white'], dtype=np.float64) /
+                                                    np.asarray(measurement['area'], dtype=np.float64))
+            if self.sweep is not None:
+                self.columns['porosity_curve'].append(self.image_analysis.porosity_curve_from_cells(measurement,
+                                                                                                    self.sweep))
+
+    def write_row(self, row):
+        """
+        Writes a row to the '.csv' table, flushing it every 'checkpoint' rows.
+        :param row: the row, as built by 'ImageAnalysis.csv_row'.
+        :return: Nothing.
+        """
+        with telemetry.stage('write_results') as stage:
+            start = self.csv_file.tell()
+            self.writer.writerow(row)
+            self.rows += 1
+            if self.rows % self.checkpoint == 0:
+                self.csv_file.flush()
+            stage.add(bytes_written=self.csv_file.tell() - start)
+
+    def flush(self):
+        """
+        Pushes the rows written so far to disk.
+        :return: Nothing.
+        """
+        if self.background is not None:
+            self.background.drain()
+        if self.csv_file is not None:
+            self.csv_file.flush()
+
+    def close(self):
+        """
+        Closes the '.csv' table and, if required, saves the '.npz' file. Its arrays are:
+        'file_name' (images), 'threshes' (thresholds), 'leaf_pix' (images), 'crown_pix' and 'fraction_cover'
+        (images x thresholds), 'cell_white_ratio' (images x rectangles of the grid), 'latitude', 'longitude' and
+        'timestamp' (images, read from the names by 'parse_image_name', NaN if absent) and, with 'sweep',
+        'sweep_threshes' and 'porosity_curve' (images x sweep thresholds).
+        :return: Nothing.
+        """
+        if self.background is not None:
+            self.background.drain()
+        if self.csv_file is not None:
+            self.csv_file.close()
+            self.csv_file = None
+        if self.columnar:
+            n_thresh = len(self.image_analysis.threshes)
+            arrays = {'file_name': np.array(self.columns['file_name']),
+                      'threshes': np.array(self.image_analysis.threshes, dtype=np.float64),
+                      'leaf_pix': np.array(self.columns['leaf_pix'], dtype=np.int64),
+                      'crown_pix': np.array(self.columns['crown_pix'], dtype=np.int64).reshape(-1, n_thresh),
+                      'fraction_cover': np.array(self.columns['fraction_cover'],
+                                                 dtype=np.float64).reshape(-1, n_thresh),
+                      'cell_white_ratio': np.array(self.columns['cell_white_ratio'], dtype=np.float64)}
+            arrays['latitude'], arrays['longitude'], arrays['timestamp'] = parse_image_names(self.columns['file_name'])
+            if self.sweep is not None:
+                arrays['sweep_threshes'] = self.sweep
+                arrays['porosity_curve'] = np.array(self.columns['porosity_curve'],
+                                                    dtype=np.float64).reshape(-1, len(self.sweep))
+            np.savez(self.image_analysis.results_path('npz'), **arrays)
+
+    @staticmethod
+    def load_columnar(path):
+        """
+        Loads the arrays saved by 'close'.
+        :param path: the '.npz' file path.
+        :return: a dictionary of arrays.
+        """
+        data = np.load(path)
+        return dict((key, data[key]) for key in data.files)
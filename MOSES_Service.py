@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+#
+
+import os
+import sys
+import json
+import time
+import traceback
+import SocketServer
+from MOSES_Parallel import batch_map
+
+
+class AnalysisService(object):
+    """
+    Class which keeps a 'Pipeline' loaded, with its calibration, undistortion maps and analysis settings, and answers
+    analysis requests for as long as it runs. A program which analyses the images one at a time, as they are captured,
+    then doesn't pay for the interpreter startup, the imports and the calibration parsing of every call.
+    The protocol is made of JSON lines. A request looks like {"id": 1, "path": "C:\\FOTO\\img.jpg"}: the path is an
+    image or a directory, whose '.jpg' images are all analysed. {"command": "ping"} checks that the service is alive
+    and {"command": "stop"} stops it. Every request gets exactly one answer line, with the same "id".
+    """
+    def __init__(self, pipeline, **kwargs):
+        """
+        Constructor.
+        :param pipeline: the 'Pipeline' which processes the images. Its 'file_list' is not used.
+        :param kwargs: - 'extensions': the extensions of the images of a directory, ('.jpg',) by default.
+        """
+        self.pipeline = pipeline
+        self.extensions = kwargs['extensions'] if ('extensions' in kwargs.keys()) else ('.jpg',)
+        self.labels = pipeline.image_analysis.csv_header()[2:]
+        # Set by the 'stop' command.
+        self.stopped = False
+
+    def images(self, path):
+        """
+        Lists the images of a request.
+        :param path: an image or a directory.
+        :return: a list of dictionaries with keys 'name' and 'path', as in 'Pipeline.file_list'.
+        """
+        if os.path.isdir(path):
+            names = sorted(f for f in os.listdir(path) if f.lower().endswith(self.extensions))
+            return [{'name': f, 'path': os.path.join(path, f)} for f in names]
+        if os.path.isfile(path):
+            return [{'name': os.path.basename(path), 'path': path}]
+        raise IOError('no such file or directory: {}'.format(path))
+
+    def image_result(self, image, measurement, error):
+        """
+        Builds the answer for one image.
+        :param image: the dictionary of the image.
+        :param measurement: the dictionary returned by 'ImageAnalysis.measure_array', None if the processing failed.
+        :param error: the formatted traceback of the failure, None otherwise.
+        :return: a dictionary with keys 'name', 'path' and either 'error', or 'leaf_pix' and 'porosity' (the value of
+        each threshold column of the '.csv' table, by column name).
+        """
+        result = {'name': image['name'], 'path': image['path']}
+        if error is not None:
+            result['error'] = error
+            return result
+        analysis = self.pipeline.image_analysis
+        porosities = analysis.porosities(analysis.fraction_cover_from_cells(measurement))
+        result['leaf_pix'] = int(measurement['leaf_pix'])
+        result['porosity'] = dict(zip(self.labels, [float(p) for p in porosities]))
+        return result
+
+    def analyse(self, path):
+        """
+        Analyses an image or all the images of a directory. The images are decoded ahead on background threads, see
+        'MOSES_Parallel.prefetch_map'.
+        :param path: an image or a directory.
+        :return: a list with the answer of each image, see 'image_result'.
+        """
+        results = batch_map(self.pipeline, 'analyse_decoded', self.images(path), 1, read='decode_image',
+                            prefetch=self.pipeline.prefetch)
+        return [self.image_result(image, measurement, error) for image, measurement, error in results]
+
+    def handle(self, request):
+        """
+        Answers a request.
+        :param request: the request, as decoded from its JSON line.
+        :return: the answer, a dictionary with keys 'id', 'status' ('ok' or 'error'), and 'results' and 'seconds' for
+        an analysis or 'error' for a failed request.
+        """
+        if not isinstance(request, dict):
+            return {'id': None, 'status': 'error', 'error': 'the request must be a JSON object'}
+        answer = {'id': request.get('id'), 'status': 'ok'}
+        command = request.get('command', 'analyse')
+        if command == 'ping':
+            return answer
+        if command == 'stop':
+            self.stopped = True
+            return answer
+        if command != 'analyse' or 'path' not in request:
+            answer.update(status='error', error='unknown command or missing "path"')
+            return answer
+        if not isinstance(request['path'], basestring):
+            answer.update(status='error', error='"path" must be a string')
+            return answer
+        start = time.time()
+        try:
+            answer['results'] = self.analyse(request['path'])
+        except (IOError, OSError) as e:
+            answer.update(status='error', error=str(e))
+            return answer
+        answer['seconds'] = time.time() - start
+        return answer
+
+    def serve_stream(self, requests, answers):
+        """
+        Answers the requests read from a stream, until it ends or the 'stop' command. A request which fails in any
+        other way gets an error answer with the traceback, and the service goes on.
+        :param requests: the stream of the JSON lines of the requests.
+        :param answers: the stream the JSON lines of the answers are written to.
+        :return: Nothing.
+        """
+        for line in iter(requests.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                answer = {'id': None, 'status': 'error', 'error': 'invalid JSON: {}'.format(e)}
+            else:
+                try:
+                    answer = self.handle(request)
+                except Exception:
+                    request_id = request.get('id') if isinstance(request, dict) else None
+                    answer = {'id': request_id, 'status': 'error', 'error': traceback.format_exc()}
+            answers.write(json.dumps(answer, sort_keys=True) + '\n')
+            answers.flush()
+            if self.stopped:
+                return
+
+    def serve_stdin(self):
+        """
+        Answers the requests read from the standard input, one answer line on the standard output for each. Anything
+        else printed meanwhile, such as the progress of the analysis, goes to the standard error. The first line is
+        {"status": "ready"}: the lines printed before it can be skipped.
+        :return: Nothing.
+        """
+        answers = sys.stdout
+        sys.stdout = sys.stderr
+        try:
+            answers.write(json.dumps({'status': 'ready'}) + '\n')
+            answers.flush()
+            self.serve_stream(sys.stdin, answers)
+        finally:
+            sys.stdout = answers
+
+    def serve_socket(self, port, host='127.0.0.1'):
+        """
+        Answers the requests sent over TCP connections, as JSON lines, until the 'stop' command. The connections are
+        served one at a time, in the order they come. Only local connections are accepted by default.
+        :param port: the TCP port, 0 to pick a free one.
+        :param host: the address to listen on.
+        :return: Nothing.
+        """
+        service = self
+
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                service.serve_stream(self.rfile, self.wfile)
+
+        server = SocketServer.TCPServer((host, port), Handler)
+        try:
+            print 'Serving on {}:{}'.format(*server.server_address)
+            sys.stdout.flush()
+            while not self.stopped:
+                server.handle_request()
+        finally:
+            server.server_close()
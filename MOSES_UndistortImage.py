@@ -4,50 +4,67 @@
 import numpy as np
 import cv2
 import os
+import hashlib
+import zipfile
 import xml.etree.ElementTree as Et
 import subprocess
 import time
 import argparse
+from MOSES_Parallel import batch_map, AsyncWriter
+from MOSES_Profiling import telemetry
+from MOSES_BufferPool import BufferPool, NO_BUFFERS
+
+# Bytes per pixel 'Undistort.undistort_gray_rows' takes on top of the grayscale rows it returns: the color rows, 3
+# bytes, and the maps of the band, 4 and 2 bytes.
+ROWS_BYTES_PER_PIXEL = 9
 
 
 class Undistort(object):
     """
     Class which contains functions definition to perform the fish-eye distortion removal from set of images.
     """
-    def __init__(self, img_dir, cam_matrix, dist_c):
+    def __init__(self, img_dir, cam_matrix, dist_c, **kwargs):
         """
         Constructor.
         img_dir : directory path containing '.jpg' images;
         cam_matrix : camera's matrix obtained from the camera calibration process;
         dist_c : camera's distortion coefficient obtained from the camera calibration process;
+        kwargs : - 'calibration_path': the calibration results file cam_matrix and dist_c come from. If given, the
+                 undistortion maps are cached next to it and reused by the following runs;
+                 - 'alpha': free scaling parameter of the optimal new camera matrix, 1 by default;
+                 - 'file_list': the images to undistort, as dictionaries with keys 'name' and 'path'. The '.jpg' files
+                 of img_dir by default.
         """
         self.image_directory = img_dir
-        self.save_path = img_dir + '\Undistorted_Images'
+        self.save_path = os.path.join(img_dir, 'Undistorted_Images')
         if not os.path.exists(self.save_path):
             os.makedirs(self.save_path)
 
-        self.file_list = self.get_image_list()
+        self.file_list = kwargs['file_list'] if ('file_list' in kwargs.keys()) else self.get_image_list()
         self.camera_matrix = cam_matrix
         self.distortion_coefficient = dist_c
+        self.calibration_path = kwargs['calibration_path'] if ('calibration_path' in kwargs.keys()) else None
+        self.alpha = kwargs['alpha'] if ('alpha' in kwargs.keys()) else 1
+        # Undistortion maps, new camera matrix and roi of each image size, computed once per run.
+        self.remap_tables = dict()
+        # New camera matrix and roi of each image size undistorted by bands of rows only, see 'remap_geometry'.
+        self.remap_geometries = dict()
+        # The 'AsyncWriter' of the undistorted images while 'undistort_all' works in the current process.
+        self.background = None
+        # The working arrays of the undistortion, reused from image to image.
+        self.buffers = BufferPool()
 
-        if len(self.file_list) > 0:
-            if cam_matrix is not None and dist_c is not None:
-                img = cv2.imread(self.file_list[0]["path"])
-                h, w = img.shape[:2]
-                print("img.shape")
-                print(img.shape)
-                self.newcameramtx, self.roi = cv2.getOptimalNewCameraMatrix(self.camera_matrix,
-                                                                            self.distortion_coefficient,
-                                                                            (w, h),
-                                                                            1,
-                                                                            (w, h))
-                print("newOptimalCameraMatrix")
-                print(self.newcameramtx)
-                print("self.roi")
-                print(self.roi)
-        else:
+        # The optimal new camera matrix and the roi are computed with the maps of each image size, when the first
+        # image of that size is undistorted: an unreadable image is then reported by its own processing only.
+        if len(self.file_list) == 0:
             print "ERROR: Empty folder: .jpg files required"
 
+    def __getstate__(self):
+        # The writer thread stays in the main process: the worker processes write the images themselves.
+        state = self.__dict__.copy()
+        state['background'] = None
+        return state
+
     def get_image_list(self):
         """
         Creates a list of the '.jpg' files contained in 'self.image_directory'.
@@ -57,9 +74,152 @@ class Undistort(object):
         file_list = []
         for f in os.listdir(self.image_directory):
             if f.endswith('.jpg'):
-                file_list.append({"path": self.image_directory+'\\'+f, "name": f})
+                file_list.append({"path": os.path.join(self.image_directory, f), "name": f})
         return file_list
 
+    def calibration_signature(self):
+        """
+        Gets a short digest identifying the calibration and the alpha the images are undistorted with.
+        :return: the digest as an hexadecimal string.
+        """
+        digest = hashlib.md5()
+        digest.update(np.ascontiguousarray(self.camera_matrix, dtype=np.float64).tobytes())
+        digest.update(np.ascontiguousarray(self.distortion_coefficient, dtype=np.float64).tobytes())
+        digest.update(repr(float(self.alpha)))
+        return digest.hexdigest()
+
+    def remap_cache_path(self, size, reduction=1):
+        """
+        Gets the path of the file caching the undistortion maps of an image size. The file is placed next to the
+        calibration results file, so each calibration has its own cache entries.
+        :param size: the image size as (width, height).
+        :param reduction: the factor the images are reduced by when decoded, see 'read_image'.
+        :return: the cache file path, None if the calibration file is unknown.
+        """
+        if self.calibration_path is None:
+            return None
+        base = os.path.splitext(self.calibration_path)[0]
+        suffix = '_reduced{}'.format(reduction) if reduction > 1 else ''
+        return '{}_remap_{}x{}_alpha{:g}{}.npz'.format(base, size[0], size[1], self.alpha, suffix)
+
+    def scaled_camera_matrix(self, reduction=1):
+        """
+        Scales the camera matrix to the images reduced when decoded. The distortion coefficients apply to normalized
+        coordinates, so they don't change.
+        :param reduction: the factor the images are reduced by.
+        :return: the camera matrix of the reduced images.
+        """
+        if reduction == 1:
+            return self.camera_matrix
+        cm = np.array(self.camera_matrix, dtype=np.float64)
+        cm[0, 0] /= reduction
+        cm[1, 1] /= reduction
+        # The centers of the pixels, not their corners, are scaled.
+        cm[0, 2] = (cm[0, 2] + 0.5) / reduction - 0.5
+        cm[1, 2] = (cm[1, 2] + 0.5) / reduction - 0.5
+        return cm
+
+    def build_remap_table(self, size, reduction=1):
+        """
+        Computes the optimal new camera matrix, the region of interest and the undistortion maps of an image size.
+        :param size: the image size as (width, height).
+        :param reduction: the factor the images are reduced by when decoded, see 'read_image'.
+        :return: a dictionary with keys 'map1', 'map2', 'new_camera_matrix' and 'roi'.
+        """
+        camera_matrix = self.scaled_camera_matrix(reduction)
+        newcameramtx, roi = cv2.getOptimalNewCameraMatrix(camera_matrix, self.distortion_coefficient,
+                                                          size, self.alpha, size)
+        map1, map2 = cv2.initUndistortRectifyMap(camera_matrix, self.distortion_coefficient, None,
+                                                 newcameramtx, size, cv2.CV_16SC2)
+        return {'map1': map1, 'map2': map2, 'new_camera_matrix': newcameramtx, 'roi': tuple(roi)}
+
+    def load_remap_table(self, cache_path, reduction=1):
+        """
+        Loads the undistortion maps from a cache file.
+        :param cache_path: the cache file path.
+        :param reduction: the factor the images are reduced by when decoded, see 'read_image'.
+        :return: the same dictionary as 'build_remap_table', None if the file is missing, unreadable or was computed
+        from a different calibration.
+        """
+        if not os.path.exists(cache_path):
+            return None
+        try:
+            data = np.load(cache_path)
+            if not (np.array_equal(data['camera_matrix'], self.scaled_camera_matrix(reduction)) and
+                    np.array_equal(data['distortion_coefficient'], self.distortion_coefficient)):
+                return None
+            return {'map1': data['map1'], 'map2': data['map2'], 'new_camera_matrix': data['new_camera_matrix'],
+                    'roi': tuple(int(v) for v in data['roi'])}
+        except (IOError, ValueError, KeyError, zipfile.BadZipfile):
+            return None
+
+    def save_remap_table(self, cache_path, reduction, table):
+        """
+        Writes the undistortion maps to their cache file. The file is replaced only once fully written, so that a
+        crash, or another process reading it meanwhile, never meets a truncated one. A failed write is only reported:
+        the maps are then computed again by the next run.
+        :param cache_path: the file path, see 'remap_cache_path'.
+        :param reduction: the factor the images are reduced by when decoded.
+        :param table: the dictionary returned by 'build_remap_table'.
+        :return: Nothing.
+        """
+        # Each process has its own temporary file, since the workers of a run may all build the same maps.
+        tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        try:
+            # Written through a file object, as 'np.savez' would add '.npz' to the temporary file name.
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, camera_matrix=self.scaled_camera_matrix(reduction),
+                         distortion_coefficient=self.distortion_coefficient, **table)
+            if os.path.exists(cache_path):
+                os.remove(cache_path)
+            os.rename(tmp_path, cache_path)
+        except (IOError, OSError) as e:
+            print 'WARNING: the undistortion maps could not be cached in {}: {}'.format(cache_path, e)
+            if os.path.exists(tmp_path):
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+    def get_remap_table(self, size, reduction=1):
+        """
+        Gets the undistortion maps of an image size. They are computed only the first time a size is met: later
+        requests are served from memory or from the cache file written next to the calibration file.
+        :param size: the image size as (width, height).
+        :param reduction: the factor the images are reduced by when decoded, see 'read_image'. The calibration is
+        scaled to match.
+        :return: a dictionary with keys 'map1', 'map2', 'new_camera_matrix' and 'roi'.
+        """
+        key = tuple(int(v) for v in size) + (reduction,)
+        if key not in self.remap_tables:
+            size = key[:2]
+            cache_path = self.remap_cache_path(size, reduction)
+            table = self.load_remap_table(cache_path, reduction) if cache_path is not None else None
+            if table is None:
+                table = self.build_remap_table(size, reduction)
+                if cache_path is not None:
+                    self.save_remap_table(cache_path, reduction, table)
+            self.remap_tables[key] = table
+        return self.remap_tables[key]
+
+    def remap_geometry(self, size, reduction=1):
+        """
+        Gets the optimal new camera matrix and the region of interest of an image size, without the undistortion maps
+        unless they are already loaded.
+        :param size: the image size as (width, height).
+        :param reduction: the factor the images are reduced by when decoded, see 'read_image'.
+        :return: a dictionary with keys 'new_camera_matrix' and 'roi'.
+        """
+        key = tuple(int(v) for v in size) + (reduction,)
+        if key in self.remap_tables:
+            return self.remap_tables[key]
+        if key not in self.remap_geometries:
+            newcameramtx, roi = cv2.getOptimalNewCameraMatrix(self.scaled_camera_matrix(reduction),
+                                                              self.distortion_coefficient, key[:2], self.alpha,
+                                                              key[:2])
+            self.remap_geometries[key] = {'new_camera_matrix': newcameramtx, 'roi': tuple(roi)}
+        return self.remap_geometries[key]
+
     def undistort_image(self, image_path):
         """
         Performs the actual distortion removal on single image.
@@ -67,22 +227,208 @@ class Undistort(object):
         :return: the undistorted image. The size of which is different than the original image's to account the region
         of interest (roi).
         """
-        img = cv2.imread(image_path)
-        dst = cv2.undistort(img, self.camera_matrix, self.distortion_coefficient, None, self.newcameramtx)
+        return self.undistort_array(self.read_image(image_path))
+
+    @staticmethod
+    def read_image(image_path, flags=cv2.IMREAD_COLOR, reduction=1):
+        """
+        Decodes an image file.
+        :param image_path: the image file path.
+        :param flags: the 'cv2.imread' flags, 'cv2.IMREAD_COLOR' or 'cv2.IMREAD_GRAYSCALE' with a reduction.
+        :param reduction: 1, 2, 4 or 8: the factor the width and height are divided by. A JPEG is then decoded at
+        the reduced size straight away, which is much faster. OpenCV versions without the reduced decoding flags
+        decode the full image and shrink it.
+        :return: the image.
+        """
+        if reduction not in (1, 2, 4, 8):
+            raise ValueError('The reduction must be 1, 2, 4 or 8, not {}'.format(reduction))
+        with telemetry.stage('decode') as stage:
+            if reduction == 1:
+                img = cv2.imread(image_path, flags)
+            else:
+                mode = 'GRAYSCALE' if flags == cv2.IMREAD_GRAYSCALE else 'COLOR'
+                reduced_flags = getattr(cv2, 'IMREAD_REDUCED_{}_{}'.format(mode, reduction), None)
+                if reduced_flags is not None:
+                    img = cv2.imread(image_path, reduced_flags)
+                else:
+                    img = cv2.imread(image_path, flags)
+                    if img is not None:
+                        img = cv2.resize(img, None, fx=1.0 / reduction, fy=1.0 / reduction,
+                                         interpolation=cv2.INTER_AREA)
+            if img is None:
+                raise IOError('Unable to read image: ' + image_path)
+            stage.add(bytes_read=os.path.getsize(image_path), pixels=img.shape[0] * img.shape[1])
+        return img
+
+    @staticmethod
+    def write_image(image_path, img):
+        """
+        Encodes an image to file.
+        :param image_path: the image file path.
+        :param img: the image.
+        :return: Nothing.
+        """
+        with telemetry.stage('write') as stage:
+            cv2.imwrite(image_path, img)
+            stage.add(bytes_written=os.path.getsize(image_path), pixels=img.shape[0] * img.shape[1])
+
+    def undistort_array(self, img, reduction=1, buffers=NO_BUFFERS):
+        """
+        Performs the distortion removal on an image already loaded in memory.
+        :param img: the image, either color or grayscale.
+        :param reduction: the factor the image was reduced by when decoded, see 'read_image'.
+        :param buffers: the 'BufferPool' the result is written to, overwritten by the next image. By default the
+        result is an array of its own.
+        :return: the undistorted image, cropped to the region of interest (roi).
+        """
+        h, w = img.shape[:2]
+        table = self.get_remap_table((w, h), reduction)
+        pixels = w * h
+        x, y, w, h = table['roi']
+        # Only the region of interest is remapped, straight into an array of its size.
+        with telemetry.stage('undistort', pixels=pixels):
+            return cv2.remap(img, table['map1'][y: y + h, x: x + w], table['map2'][y: y + h, x: x + w],
+                             cv2.INTER_LINEAR, dst=buffers.get('undistorted', (h, w) + img.shape[2:], img.dtype))
+
+    def undistorted_shape(self, img, reduction=1):
+        """
+        Gets the shape 'undistort_array' gives to an image, without undistorting it.
+        :param img: the image.
+        :param reduction: the factor the image was reduced by when decoded, see 'read_image'.
+        :return: the height and width of the region of interest (roi).
+        """
+        h, w = img.shape[:2]
+        x, y, w, h = self.remap_geometry((w, h), reduction)['roi']
+
+        return h, w
+
+    def undistort_rows(self, img, first, last, reduction=1):
+        """
+        Performs the distortion removal of a band of rows only. The maps of the band are computed for it alone, so the
+        maps of the whole image are never held: the new camera matrix is moved so that the band starts at its origin,
+        which gives the same maps as the rows of those of 'get_remap_table'.
+        :param img: the image, either color or grayscale.
+        :param first: the first row of the band, in the undistorted image.
+        :param last: the row after the last one of the band.
+        :param reduction: the factor the image was reduced by when decoded, see 'read_image'.
+        :return: the rows 'first' to 'last' (excluded) of the image returned by 'undistort_array'.
+        """
+        h, w = img.shape[:2]
+        geometry = self.remap_geometry((w, h), reduction)
+        x, y, w, h = geometry['roi']
+        newcameramtx = np.array(geometry['new_camera_matrix'], dtype=np.float64)
+        newcameramtx[0, 2] -= x
+        newcameramtx[1, 2] -= y + first
+        with telemetry.stage('undistort', pixels=(last - first) * w):
+            map1, map2 = cv2.initUndistortRectifyMap(self.scaled_camera_matrix(reduction), self.distortion_coefficient,
+                                                     None, newcameramtx, (w, last - first), cv2.CV_16SC2)
+            return cv2.remap(img, map1, map2, cv2.INTER_LINEAR)
+
+    def undistort_gray_rows(self, img, first, last, reduction=1):
+        """
+        Performs the distortion removal of a band of rows of a color image and converts them to grayscale, giving the
+        same rows as 'undistort_decoded'.
+        :param img: the color image.
+        :param first: the first row of the band, in the undistorted image.
+        :param last: the row after the last one of the band.
+        :param reduction: the factor the image was reduced by when decoded, see 'read_image'.
+        :return: the grayscale rows 'first' to 'last' (excluded).
+        """
+        return cv2.cvtColor(self.undistort_rows(img, first, last, reduction), cv2.COLOR_BGR2GRAY)
+
+    def load_undistorted(self, image_path, save_name=None, reduction=1):
+        """
+        Decodes an image once and returns it undistorted and converted to grayscale, ready for the analysis.
+        :param image_path: the image file path.
+        :param save_name: if given, the undistorted color image is also saved in 'self.save_path' with this name.
+        :param reduction: the factor the image is reduced by when decoded, see 'read_image'.
+        :return: the undistorted grayscale image, overwritten by the next one, see 'undistort_decoded'.
+        """
+        return self.undistort_decoded(self.read_image(image_path, cv2.IMREAD_COLOR, reduction), save_name, reduction)
 
-        x, y, w, h = self.roi
+    def undistort_decoded(self, img, save_name=None, reduction=1, background=None):
+        """
+        Undistorts an image already decoded and converts it to grayscale, see 'load_undistorted'. The color image is
+        undistorted and cropped first, whether it is saved or not, so that the results don't depend on saving it.
+        :param img: the color image.
+        :param save_name: if given, the undistorted color image is also saved in 'self.save_path' with this name.
+        :param reduction: the factor the image was reduced by when decoded, see 'read_image'.
+        :param background: an 'AsyncWriter' which saves the image, None to save it straight away.
+        :return: the undistorted grayscale image, in a buffer of 'self.buffers' overwritten by the next image.
+        """
+        if save_name is None:
+            img = self.undistort_array(img, reduction, self.buffers)
+        else:
+            # The color image may still be waiting to be written when the next one is undistorted: it has its own
+            # array.
+            img = self.undistort_array(img, reduction)
+            self.save_image(save_name, img, background)
 
-        return dst[y: y + h, x: x + w]
+        return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=self.buffers.get('gray', img.shape[:2]))
 
-    def undistort_all(self):
+    def save_image(self, save_name, img, background=None):
+        """
+        Saves an undistorted image in 'self.save_path'.
+        :param save_name: the file name.
+        :param img: the image. It must not be modified afterwards if the write is in the background.
+        :param background: an 'AsyncWriter' which saves the image, None to save it straight away.
+        :return: Nothing.
+        """
+        print "saving:", save_name
+        save_path = os.path.join(self.save_path, save_name)
+        # The images of the subfolders of a survey are saved in the same subfolders.
+        if not os.path.exists(os.path.dirname(save_path)):
+            os.makedirs(os.path.dirname(save_path))
+        if background is not None:
+            background.submit(self.write_image, save_path, img)
+        else:
+            self.write_image(save_path, img)
+
+    def undistort_all(self, jobs=1, prefetch=2):
         """
         Performs undistortion on all images and save the results to file.
+        :param jobs: the number of processes undistorting the images in parallel, 0 to use all the cores. An image
+        which can't be undistorted is reported and skipped.
+        :param prefetch: in the current process, the number of images decoded ahead on background threads while an
+        image is undistorted; the images are then also written on a background thread. 0 does everything in turn.
+        :return: Nothing
+        """
+        background = AsyncWriter() if prefetch > 0 else None
+        self.background = background
+        try:
+            for image_path, result, error in batch_map(self, 'save_decoded', self.file_list, jobs,
+                                                       read='decode_image', prefetch=prefetch):
+                if error is not None:
+                    print 'ERROR: undistortion of', image_path['name'], 'failed:', error
+        finally:
+            self.background = None
+            if background is not None:
+                background.close()
+
+    def decode_image(self, image_path):
+        """
+        Decodes an image of 'self.file_list' in color.
+        :param image_path: a dictionary of 'self.file_list', with keys 'name' and 'path'.
+        :return: the image.
+        """
+        return self.read_image(image_path['path'])
+
+    def save_decoded(self, img, image_path):
+        """
+        Performs undistortion on an image decoded by 'decode_image' and save the result to file.
+        :param img: the decoded image.
+        :param image_path: a dictionary of 'self.file_list', with keys 'name' and 'path'.
+        :return: Nothing
+        """
+        self.save_image(image_path['name'], self.undistort_array(img), self.background)
+
+    def save_undistorted(self, image_path):
+        """
+        Performs undistortion on a single image and save the result to file.
+        :param image_path: a dictionary of 'self.file_list', with keys 'name' and 'path'.
         :return: Nothing
         """
-        for image_path in self.file_list:
-            img = self.undistort_image(image_path['path'])
-            print "saving:", image_path['name']
-            cv2.imwrite(self.save_path+'\\' + image_path['name'], img)
+        self.save_decoded(self.decode_image(image_path), image_path)
 
     def get_undistorted_file_path(self):
         """
@@ -92,7 +438,7 @@ class Undistort(object):
         name_list = [x['name'] for x in self.file_list]
         directory = self.save_path
 
-        return directory+"\\", name_list
+        return directory+os.sep, name_list
 
     @staticmethod
     def load_from_xml(path, data_name):
@@ -145,7 +491,7 @@ def main():
     print 'Distortion Coefficient = ', dc
     directory = (".\fototest")
     
-    u = Undistort(directory, cm, dc)
+    u = Undistort(directory, cm, dc, calibration_path=parameters_path)
     u.undistort_all()
 
 if __name__ == '__main__':
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+#
+
+import os
+import time
+
+
+class FolderWatcher(object):
+    """
+    Class which polls a directory for the images a camera keeps writing to it. An image is reported once, as soon as
+    it looks fully written: its file was not modified for 'settle' seconds and, for a '.jpg', it ends with the JPEG
+    end of image marker.
+    """
+    def __init__(self, directory, **kwargs):
+        """
+        Constructor.
+        :param directory: the watched directory.
+        :param kwargs: - 'extensions': the extensions of the image files, ('.jpg',) by default;
+                       - 'settle': the seconds a file must stay unmodified to be considered complete, 2 by default;
+                       - 'give_up': the seconds after which a '.jpg' without end marker is reported all the same, so
+                       that its analysis reports the error. 60 by default.
+        """
+        self.directory = directory
+        self.extensions = kwargs['extensions'] if ('extensions' in kwargs.keys()) else ('.jpg',)
+        self.settle = kwargs['settle'] if ('settle' in kwargs.keys()) else 2.0
+        self.give_up = kwargs['give_up'] if ('give_up' in kwargs.keys()) else 60.0
+        # The names of the files already reported.
+        self.reported = set()
+
+    @staticmethod
+    def has_jpeg_end(file_path):
+        """
+        Checks whether a file ends with the JPEG end of image marker, which the camera writes last.
+        :param file_path: the file path.
+        :return: True if the last two bytes are the marker.
+        """
+        with open(file_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() < 2:
+                return False
+            f.seek(-2, os.SEEK_END)
+            return f.read(2) == b'\xff\xd9'
+
+    def is_complete(self, file_path, now):
+        """
+        Checks whether a file looks fully written.
+        :param file_path: the file path.
+        :param now: the current time.
+        :return: True if the file can be processed.
+        """
+        st = os.stat(file_path)
+        age = now - st.st_mtime
+        if st.st_size == 0 or age < self.settle:
+            return False
+        if file_path.lower().endswith(('.jpg', '.jpeg')) and age < self.give_up:
+            return self.has_jpeg_end(file_path)
+        return True
+
+    def poll(self):
+        """
+        Looks for the images completed since the previous call.
+        :return: a list containing a dictionary for each new image, with keys name and path, sorted by name.
+        """
+        now = time.time()
+        images = []
+        for f in sorted(os.listdir(self.directory)):
+            if f in self.reported or not f.lower().endswith(self.extensions):
+                continue
+            file_path = os.path.join(self.directory, f)
+            try:
+                complete = self.is_complete(file_path, now)
+            except (IOError, OSError):
+                # Removed or renamed while being checked.
+                continue
+            if complete:
+                self.reported.add(f)
+                images.append({"path": file_path, "name": f})
+        return images
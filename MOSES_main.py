@@ -1,11 +1,20 @@
 # -*- coding: utf-8 -*-
 # 
 
-from MOSES_ImageAnalysis import ImageAnalysis
+from MOSES_ImageAnalysis import ImageAnalysis, THRESHES
 from MOSES_UndistortImage import Undistort
+from MOSES_Pipeline import Pipeline
+from MOSES_Watch import FolderWatcher
+from MOSES_MaskCache import MaskCache
+from MOSES_Service import AnalysisService
+from MOSES_Calibration import CalibrationRegistry
+from MOSES_Profiling import telemetry
+import cProfile
+import pstats
 import time
 import subprocess
 import argparse
+import sys
 import os
 """
 Performs a full image's undistortion and analysis on all the images of a given folder. If called with '-c' it runs a
@@ -25,7 +34,7 @@ def get_image_list(image_directory):
     file_list = []
     for f in os.listdir(image_directory):
         if f.endswith('.jpg'):
-            file_list.append({"path": image_directory+'\\'+f, "name": f})
+            file_list.append({"path": os.path.join(image_directory, f), "name": f})
     return file_list
 
 def get_undistorted_file_path(file_list, directory):
@@ -35,62 +44,178 @@ def get_undistorted_file_path(file_list, directory):
     """
     name_list = [x['name'] for x in file_list]
     directory = directory
-    return directory+"\\", name_list
+    return directory+os.sep, name_list
 ###########################################################################   
-#importante: con chiamata -c FA CALIRBAZIONE, con chiamata -D NON FA UNDISTORT
-##IMPOSTA CARTELLA DI LAVORO:
 
-path =".\FOTO_CC_05072018"
-print("####path")
-print(path)
-parameters_path = 'out_CAMERADATA_Orizzontal.xml'
-
-#valuta parametri di run
-parser = argparse.ArgumentParser(description='Undistort images.')
-parser.add_argument('-c', action='store_true',
-                    help='run calibration prior to undistorting')
-parser.add_argument('-d', action='store_true')
-args = parser.parse_args()
-calibrate = args.c
-SkipUndist = args.d
-##
-if calibrate:
-    calibration_app_path = [".\Camera_Calibration_Orizzontal.exe",
-                                ".\default_orizzontal.xml"]
-    print "Calibration in progress..."
-    calibration = subprocess.check_output(calibration_app_path)
-    time.sleep(1)
-##
-if SkipUndist:
-    
-    file_listPATH = get_image_list(path)
-    directory, file_list = get_undistorted_file_path(file_listPATH, path)
-    print "file_list"
-    print file_list
-    print "directory"
-    print directory    
-else:   
-    print "Elimination of distortion process is starting..."
-    cm = Undistort.load_from_xml(parameters_path, 'Camera_Matrix')
-    dc = Undistort.load_from_xml(parameters_path, 'Distortion_Coefficients')   
-    u = Undistort(path, cm, dc)
-    print("cm parameters:" ,  cm)
-    print("dc parameters:" ,  dc)
-    u.undistort_all()
-    print "Elimination of distortion process completed!"
-    directory, file_list = u.get_undistorted_file_path()
-    print("directory")
-    print(directory)
-    print("file_list")
-    print(file_list)
-## ESEGUI CALCOLO CANOPY COVER
-threshes = [0.40, 0.43, 0.45, 0.50, 0.55, 0.60, 0.65, 0.70, 0.75, 0.80, 0.85, 0.90, 0.95, 1.10]
-print "Analysis is starting..."
-image_analysis = ImageAnalysis(directory, file_list, sub_sampling_size=15, rejection_area=0.1, display=True)
-image_analysis.analyse_all()
-print "Analysis is completed!"
 
+def main():
+    """
+    Runs the calibration, the undistortion and the analysis according to the command line flags. The work is kept
+    inside this function because the worker processes started by '--jobs' import this module again.
+    :return: Nothing.
+    """
+    #importante: con chiamata -c FA CALIRBAZIONE, con chiamata -D NON FA UNDISTORT
+    ##IMPOSTA CARTELLA DI LAVORO:
 
+    parameters_path = 'out_CAMERADATA_Orizzontal.xml'
 
+    #valuta parametri di run
+    parser = argparse.ArgumentParser(description='Undistort images.')
+    parser.add_argument('-c', action='store_true',
+                        help='run calibration prior to undistorting')
+    parser.add_argument('-d', action='store_true')
+    parser.add_argument('-s', action='store_true',
+                        help='save the undistorted images to the Undistorted_Images folder')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of images processed in parallel, 0 to use all the cores')
+    parser.add_argument('-r', '--resume', action='store_true',
+                        help='process only the images which are new or changed since the previous run')
+    parser.add_argument('--npz', action='store_true',
+                        help='also save the raw results as numeric arrays in results.npz')
+    parser.add_argument('--sweep', type=int, default=None,
+                        help='also save in results.npz the porosity curve of each image over SWEEP thresholds '
+                             'between 0 and 1')
+    parser.add_argument('--telemetry', default=None,
+                        help='record the time, bytes and pixels of each stage as JSON lines in this file and print '
+                             'a summary at the end')
+    parser.add_argument('--profile', action='store_true',
+                        help='run the analysis under cProfile, saving profile.pstats next to the results; implies '
+                             '--telemetry')
+    parser.add_argument('--memory-budget', type=float, default=None,
+                        help='megabytes of working memory per image: larger images are undistorted and analysed by '
+                             'bands of rows. The decoded image (3 bytes per pixel, 1 with -d) is held whole and not '
+                             'counted')
+    parser.add_argument('--display', action='store_true',
+                        help='save a panel of the result of each threshold for every image in the Display folder')
+    parser.add_argument('--path', default=".\FOTO_CC_05072018", help='the directory of the images')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep watching the directory and analyse the images as the camera writes them, until '
+                             'Ctrl+C')
+    parser.add_argument('--idle-timeout', type=float, default=None,
+                        help='with --watch, stop after this many seconds without new images')
+    parser.add_argument('--preview', type=int, default=1, choices=[1, 2, 4, 8],
+                        help='decode the images with their width and height divided by PREVIEW, for fast results, '
+                             'saved as results_previewPREVIEW.csv')
+    parser.add_argument('--preview-check', type=int, default=None, metavar='N',
+                        help='with --preview, only report the error of the preview against the full resolution on '
+                             'N images')
+    parser.add_argument('--mask-cache', default=None, metavar='DIR',
+                        help='keep the binarized images in DIR, so that running the analysis again with another grid '
+                             'or other thresholds skips decoding, undistorting and binarizing them')
+    parser.add_argument('--mask-cache-size', type=float, default=1024,
+                        help='megabytes the mask cache may take on disk, the masks used least recently are removed '
+                             'first')
+    parser.add_argument('--serve', action='store_true',
+                        help='keep the calibration and the analysis loaded and answer JSON line requests, such as '
+                             '{"path": "img.jpg"}, read from the standard input, see MOSES_Service')
+    parser.add_argument('--port', type=int, default=None,
+                        help='with --serve, answer the requests over local TCP connections on this port instead')
+    parser.add_argument('--calibrations', default=None, metavar='FILE',
+                        help='JSON file of the cameras of a survey mixing them, with the calibration of each and the '
+                             'folder, file name pattern or image size of its images, see MOSES_Calibration. The '
+                             'images of the subfolders of the directory are processed too')
+    args = parser.parse_args()
+    path = args.path
+    print("####path")
+    print(path)
+    calibrate = args.c
+    SkipUndist = args.d
+    SaveUndist = args.s
+    ##
+    if calibrate:
+        calibration_app_path = [".\Camera_Calibration_Orizzontal.exe",
+                                    ".\default_orizzontal.xml"]
+        print "Calibration in progress..."
+        calibration = subprocess.check_output(calibration_app_path)
+        time.sleep(1)
+    ##
+    if SkipUndist:
+    
+        file_listPATH = get_image_list(path)
+        directory, file_list = get_undistorted_file_path(file_listPATH, path)
+        print "file_list"
+        print file_list
+        print "directory"
+        print directory    
+    elif args.calibrations is not None:
+        print "Elimination of distortion process is starting..."
+        registry = CalibrationRegistry.from_json(args.calibrations, path)
+        file_listPATH = registry.image_list()
+        directory, file_list = get_undistorted_file_path(file_listPATH, registry.save_path)
+        print 'Cameras:', ', '.join(camera['name'] for camera in registry.cameras)
+    else:   
+        print "Elimination of distortion process is starting..."
+        cm = Undistort.load_from_xml(parameters_path, 'Camera_Matrix')
+        dc = Undistort.load_from_xml(parameters_path, 'Distortion_Coefficients')   
+        u = Undistort(path, cm, dc, calibration_path=parameters_path)
+        print("cm parameters:" ,  cm)
+        print("dc parameters:" ,  dc)
+        directory, file_list = u.get_undistorted_file_path()
+        print("directory")
+        print(directory)
+        print("file_list")
+        print(file_list)
+    ## ESEGUI CALCOLO CANOPY COVER
+    threshes = THRESHES
+    print "Analysis is starting..."
+    mask_cache = None
+    if args.mask_cache is not None:
+        mask_cache = MaskCache(args.mask_cache, max_bytes=int(args.mask_cache_size * 1024 * 1024))
+    # A preview has its own results, manifest and panels, so that it never replaces those of the full resolution.
+    results_name = 'results' if args.preview == 1 else 'results_preview{}'.format(args.preview)
+    display_dir = os.path.join(directory, 'Display' if args.preview == 1 else 'Display_preview{}'.format(args.preview))
+    image_analysis = ImageAnalysis(directory, file_list, sub_sampling_size=15, rejection_area=0.1, display=args.display,
+                                   threshes=threshes, memory_budget=args.memory_budget, mask_cache=mask_cache,
+                                   results_name=results_name, display_dir=display_dir)
+    if args.telemetry is not None or args.profile:
+        telemetry.configure(args.telemetry or os.path.join(directory, 'telemetry.jsonl'))
+    profiler = None
+    if args.profile:
+        # Only the main process is profiled: use it with --jobs 1 to see the hot path of the analysis.
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if SkipUndist:
+        pipeline = Pipeline(None, image_analysis, file_list=file_listPATH, resume=args.resume,
+                            columnar=args.npz, sweep=args.sweep, reduction=args.preview)
+    elif args.calibrations is not None:
+        # Each image is undistorted with the calibration of its camera.
+        pipeline = Pipeline(None, image_analysis, calibrations=registry, file_list=file_listPATH,
+                            save_undistorted=SaveUndist, resume=args.resume, columnar=args.npz, sweep=args.sweep,
+                            reduction=args.preview)
+    else:
+        # Undistortion and analysis run image by image in memory: the undistorted images are written only with -s.
+        pipeline = Pipeline(u, image_analysis, save_undistorted=SaveUndist, resume=args.resume,
+                            columnar=args.npz, sweep=args.sweep, reduction=args.preview)
+    if args.preview_check is not None:
+        report = pipeline.preview_report(args.preview_check)
+        print 'Preview 1/{} on {} images: {:.1f} s instead of {:.1f} s'.format(
+            args.preview, report['images'], report['seconds_preview'], report['seconds_full'])
+        for label, mean, worst in zip(report['labels'], report['mean_abs_error'], report['max_abs_error']):
+            print '    {:<30} mean abs error {:.4f}, max {:.4f}'.format(label, mean, worst)
+    elif args.serve:
+        service = AnalysisService(pipeline)
+        if args.port is not None:
+            service.serve_socket(args.port)
+        else:
+            service.serve_stdin()
+    elif args.watch:
+        pipeline.watch(FolderWatcher(path), jobs=args.jobs, idle_timeout=args.idle_timeout)
+    else:
+        pipeline.run(jobs=args.jobs)
+    # When serving on the standard output, it carries only the answers.
+    out = sys.stderr if (args.serve and args.port is None) else sys.stdout
+    if args.calibrations is not None and not SkipUndist:
+        print >> out, 'Images by camera:', registry.summary()
+    if not SkipUndist:
+        print >> out, "Elimination of distortion process completed!"
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(os.path.join(directory, 'profile.pstats'))
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(25)
+    if telemetry.enabled:
+        print >> out, telemetry.report()
+    print >> out, "Analysis is completed!"
 
 
+if __name__ == '__main__':
+    main()